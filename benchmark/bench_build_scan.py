@@ -0,0 +1,157 @@
+# Benchmark of build_scan_from_series : regroup the volumes into scans, and collapse the constant fields
+# Compare the former implementation (unique() on each column of each group), kept here as reference,
+# with the current one (nunique() on all columns of all groups at once).
+#
+# Usage : python benchmark/bench_build_scan.py [--sizes 10000 50000] [--columns 200] [--legacy_max 50000]
+
+# standard modules
+import argparse
+import time
+
+# dependency modules
+import niix2bids
+import numpy as np
+import pandas
+
+# local modules
+import nifti2database
+
+
+CONFIG = [
+    ('^tfl$'       , 'mprage'),
+    ('^epfid2d1_'  , 'bold'  ),
+    ('^fl3d'       , 'gre'   ),
+    ('^tse_vfl$'   , 'space' ),
+    ('^ep_b'       , 'dwi'   ),
+]
+
+
+########################################################################################################################
+def legacy_build_scan_from_series(df: pandas.DataFrame, config: list) -> list[dict]:
+
+    scans = []  # list[dict]
+
+    # call each routine depending on the sequence name
+    for seq_regex, fcn_name in config:  # loop over sequence decision tree
+
+        # get list of corresponding sequence
+        seqinfo = niix2bids.decision_tree.utils.slice_with_genericfield(df, 'PulseSequenceName', seq_regex)
+        if seqinfo.empty: continue  # just to run the code faster
+
+        # we group using raw json info and the "run" number from the bids decision tree in niix2bids
+        columns = ['PatientName', 'ProtocolName', 'run', 'MRAcquisitionType', 'StudyInstanceUID']
+        if 'PhaseEncodingDirection' in seqinfo:
+            columns.append('PhaseEncodingDirection')
+        # 'MRAcquisitionType' is can help sometimes for grouping
+
+        groups = seqinfo.groupby(by=columns, dropna=False)
+        for _, series in groups:
+
+            scan = series.to_dict('list')  # convert the DataFrame to standard dict
+
+            to_delete = []
+
+            for key in scan.keys():
+
+                try:
+                    unique_stuff = series[key].unique()
+                    if len(unique_stuff) == 1:
+                        scan[key] = unique_stuff[0]
+
+                except TypeError:  # unique() on 'list' is not possible, but it is on 'tuple'
+
+                    try:
+                        unique_stuff = series[key].transform(tuple).unique()
+                        if len(unique_stuff) == 1:
+                            scan[key] = unique_stuff[0]
+                    except ValueError:  # rare bug :  "ValueError: Function did not transform"
+                        pass  # in this case, just do nothing, no simplification
+
+                # remove nan
+                if (type(scan[key]) is np.float64 or type(scan[key]) is float) and np.isnan(scan[key]):
+                    to_delete.append(key)
+
+                # convert some fields into regular builtin objects
+                if type(scan[key]) is np.int64:
+                    scan[key] = int(scan[key])
+
+            for key in to_delete:  # remove keys with just a 1x1 nan
+                del scan[key]
+
+            scans.append(scan)
+
+    return scans
+
+
+########################################################################################################################
+def make_dataframe(n_volume: int, n_column: int, seed: int = 0) -> pandas.DataFrame:
+
+    rng = np.random.default_rng(seed)
+
+    # ~4 volumes per scan (mp2rage, multi-echo, magnitude/phase...), ~20 scans per session
+    n_scan     = max(n_volume // 4, 1)
+    scan_idx   = np.sort(rng.integers(0, n_scan, n_volume))
+    sequences  = np.array([regex.strip('^$_') for regex, _ in CONFIG] + ['unknown'])
+    sequence   = sequences[rng.integers(0, len(sequences), n_scan)][scan_idx]
+    session    = scan_idx // 20
+
+    df = pandas.DataFrame({
+        'PulseSequenceName'     : sequence,
+        'PatientName'           : [f"SUBJ{s}"             for s in session ],
+        'StudyInstanceUID'      : [f"1.2.{s}"             for s in session ],
+        'ProtocolName'          : [f"prot_{i % 7}"        for i in scan_idx],
+        'MRAcquisitionType'     : np.where(scan_idx % 3, '3D', '2D'),
+        'PhaseEncodingDirection': ['j-' if i % 5 else np.nan for i in scan_idx],
+        'SeriesInstanceUID'     : [f"1.2.{s}.{v}"         for v, s in enumerate(session)],
+        'run'                   : np.where(scan_idx % 11, 1.0, np.nan),
+        'EchoTime'              : np.round(rng.random(n_volume), 3),
+        'ImageType'             : [['ORIGINAL', 'PRIMARY', 'M'] if v % 2 else ['ORIGINAL', 'PRIMARY', 'P'] for v in range(n_volume)],
+        'ImageOrientationPatientDICOM': [[1, 0, 0, 0, 1, float(s % 2)] for s in scan_idx],
+    })
+
+    # other JSON fields : constant per scan, with missing values, like in a real archive
+    fields = {}
+    for idx in range(n_column - len(df.columns)):
+        kind = idx % 3
+        if kind == 0:
+            col = rng.random(n_scan)[scan_idx]
+            col[rng.random(n_volume) < 0.05] = np.nan
+        elif kind == 1:
+            col = rng.integers(0, 10, n_scan)[scan_idx]
+        else:
+            col = np.array([f"value_{v}" for v in rng.integers(0, 50, n_scan)], dtype=object)[scan_idx]
+        fields[f"Field{idx:03d}"] = col
+
+    return pandas.concat([df, pandas.DataFrame(fields)], axis=1)
+
+
+########################################################################################################################
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description="Benchmark of build_scan_from_series")
+    parser.add_argument("--sizes"     , type=int, nargs='+', default=[10_000, 50_000], help="number of volumes")
+    parser.add_argument("--columns"   , type=int, default=200   , help="number of JSON fields")
+    parser.add_argument("--legacy_max", type=int, default=50_000, help="skip the legacy implementation above this size")
+    args = parser.parse_args()
+
+    print(f"{'volumes':>10} {'scans':>8} {'legacy (s)':>12} {'current (s)':>12} {'speedup':>8}")
+    for size in args.sizes:
+
+        df = make_dataframe(size, args.columns)
+
+        start_time = time.perf_counter()
+        scans_new = nifti2database.utils.build_scan_from_series(df, CONFIG)
+        t_new = time.perf_counter() - start_time
+
+        if size <= args.legacy_max:
+            start_time = time.perf_counter()
+            scans_old = legacy_build_scan_from_series(df, CONFIG)
+            t_old = time.perf_counter() - start_time
+            assert repr(scans_new) == repr(scans_old), "build_scan_from_series output differs from the legacy implementation"
+            print(f"{size:>10,} {len(scans_new):>8,} {t_old:>12.2f} {t_new:>12.2f} {t_old/t_new:>7.1f}x")
+        else:
+            print(f"{size:>10,} {len(scans_new):>8,} {'skipped':>12} {t_new:>12.2f} {'-':>8}")
+
+
+if __name__ == "__main__":
+    main()
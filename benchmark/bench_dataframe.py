@@ -0,0 +1,151 @@
+# Benchmark of the DataFrame stages : read_all_nifti_header (without the file reading) & concat_bidsfields_to_seqparam
+# Compare the former cell-by-cell implementation, kept here as reference, with the current vectorized one.
+#
+# Usage : python benchmark/bench_dataframe.py [--sizes 10000 50000 200000] [--columns 200] [--legacy_max 50000]
+
+# standard modules
+import argparse
+import time
+import types
+
+# dependency modules
+import numpy as np
+import pandas
+
+# local modules
+import nifti2database
+
+
+########################################################################################################################
+def legacy_add_nifti_header_to_dataframe(df: pandas.DataFrame, header_list: list[tuple[tuple, tuple]]) -> pandas.DataFrame:
+
+    Matrix     = []
+    Resolution = []
+    FoV        = []
+
+    for row, (matrix, resolution) in zip(df.index, header_list):
+
+        fov = tuple([ mx*res for mx,res in zip(matrix, resolution)])
+
+        df.loc[row,'Mx'] = matrix[0]
+        df.loc[row,'My'] = matrix[1]
+        df.loc[row,'Mz'] = matrix[2]
+        if len(matrix) == 4:
+            df.loc[row,'Mt'] = matrix[3]
+        df.loc[row,'Rx'] = resolution[0]
+        df.loc[row,'Ry'] = resolution[1]
+        df.loc[row,'Rz'] = resolution[2]
+        if len(resolution) == 4:
+            df.loc[row,'Rt'] = resolution[3]
+        df.loc[row,'Fx'] = fov[0]
+        df.loc[row,'Fy'] = fov[1]
+        df.loc[row,'Fz'] = fov[2]
+        if len(fov) == 4:
+            df.loc[row,'Ft'] = fov[3]
+
+        Matrix.append(matrix)
+        Resolution.append(resolution)
+        FoV.append(fov)
+
+    df['Matrix'    ] = Matrix
+    df['Resolution'] = Resolution
+    df['FoV'       ] = FoV
+
+    return df
+
+
+########################################################################################################################
+def legacy_concat_bidsfields_to_seqparam(df: pandas.DataFrame) -> pandas.DataFrame:
+
+    for row in df.index:
+
+        # shortcut
+        vol = df.loc[row,'Volume']
+
+        for key in vol.bidsfields:
+            df.loc[row,key] = vol.bidsfields[key]
+        df.loc[row,'tag'   ] = vol.tag
+        df.loc[row,'suffix'] = vol.suffix
+        df.loc[row,'sub'   ] = vol.sub
+
+    return df
+
+
+########################################################################################################################
+def make_dataframe(n_volume: int, n_column: int, seed: int = 0) -> tuple[pandas.DataFrame, list[tuple[tuple, tuple]]]:
+
+    rng = np.random.default_rng(seed)
+
+    # JSON fields : a mix of float, int and str, with missing values like in a real archive
+    data = {}
+    for idx in range(n_column):
+        kind = idx % 3
+        if kind == 0:
+            col = rng.random(n_volume)
+            col[rng.random(n_volume) < 0.2] = np.nan
+        elif kind == 1:
+            col = rng.integers(0, 10, n_volume)
+        else:
+            col = np.array([f"value_{v}" for v in rng.integers(0, 50, n_volume)], dtype=object)
+        data[f"Field{idx:03d}"] = col
+    df = pandas.DataFrame(data)
+
+    # Volume objects : only the attributes used by concat_bidsfields_to_seqparam
+    suffixes = ['T1w', 'bold', 'MEGRE', 'dwi', 'UNIT1']
+    volume_list = []
+    for idx in range(n_volume):
+        bidsfields = {'run': int(rng.integers(1, 4))}
+        if idx % 2:
+            bidsfields['echo'] = int(rng.integers(1, 6))
+        if idx % 5 == 0:
+            bidsfields['acq'] = 'highres'
+        volume_list.append(types.SimpleNamespace(bidsfields=bidsfields, tag='anat', suffix=suffixes[idx % len(suffixes)], sub=f"SUBJ{idx//20}"))
+    df['Volume'] = volume_list
+
+    # headers : 3D & 4D volumes
+    header_list = []
+    for idx in range(n_volume):
+        if idx % 4 == 1:
+            header_list.append(((64, 64, 40, 200), tuple(np.float32([2.0, 2.0, 2.5, 1.25]))))
+        else:
+            header_list.append(((176, 256, 256), tuple(np.float32([1.0, 0.977, 0.977]))))
+
+    return df, header_list
+
+
+########################################################################################################################
+def run_stages(df: pandas.DataFrame, header_list: list, add_header, concat_bidsfields) -> tuple[pandas.DataFrame, float]:
+    start_time = time.perf_counter()
+    df = add_header(df.copy(), header_list)
+    df = concat_bidsfields(df)
+    return df, time.perf_counter() - start_time
+
+
+########################################################################################################################
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description="Benchmark of the DataFrame stages of nifti2database")
+    parser.add_argument("--sizes"     , type=int, nargs='+', default=[10_000, 50_000, 200_000], help="number of volumes")
+    parser.add_argument("--columns"   , type=int, default=200   , help="number of JSON fields")
+    parser.add_argument("--legacy_max", type=int, default=50_000, help="skip the legacy implementation above this size")
+    args = parser.parse_args()
+
+    print(f"{'volumes':>10} {'legacy (s)':>12} {'vectorized (s)':>15} {'speedup':>8}")
+    for size in args.sizes:
+
+        df, header_list = make_dataframe(size, args.columns)
+
+        df_new, t_new = run_stages(df, header_list,
+                                   nifti2database.utils.add_nifti_header_to_dataframe,
+                                   nifti2database.utils.concat_bidsfields_to_seqparam)
+
+        if size <= args.legacy_max:
+            df_old, t_old = run_stages(df, header_list, legacy_add_nifti_header_to_dataframe, legacy_concat_bidsfields_to_seqparam)
+            pandas.testing.assert_frame_equal(df_new, df_old, check_dtype=False)
+            print(f"{size:>10,} {t_old:>12.2f} {t_new:>15.2f} {t_old/t_new:>7.1f}x")
+        else:
+            print(f"{size:>10,} {'skipped':>12} {t_new:>15.2f} {'-':>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,345 @@
+# Benchmark of the whole ingest pipeline, on a synthetic dcm2niix-like archive
+# The archive is generated with 1 directory per session, each with the usual sequences of a research protocol :
+# MPRAGE, MP2RAGE (INV1/INV2/UNI/T1 series), multi-echo GRE (magnitude & phase, 1 file per echo),
+# multi-band BOLD (+ SBRef), GRE field map and multi-band DWI (+ bval/bvec).
+# The .nii/.nii.gz files have realistic headers (matrix, resolution, 4D dims...) but no voxel data :
+# the pipeline only reads the headers, and the archive stays small and fast to generate at any size.
+#
+# Each run goes through nifti2database.workflow.run(), and the per-stage metrics (see nifti2database.metrics) are
+# reported with the throughput and the peak memory. Save the results with --save, and compare them between commits
+# with --compare.
+#
+# Usage : python benchmark/bench_pipeline.py [--sessions 50] [--archive DIR] [--config_file FILE]
+#                                            [--credentials FILE | --prepare] [--workers N] [--jobs N] [--chunk_size N]
+#                                            [--repeat 1] [--save FILE] [--compare FILE]
+#
+# With --credentials, the scans are inserted in the database of the credentials file : use a test database.
+# The first run is a first-time load, the next ones (--repeat) only find scans already in database.
+# Without --credentials, '--prepare' is used : the SQL lines are written in a file, which stands in for the database.
+
+# standard modules
+import argparse
+import datetime
+import gzip
+import json
+import logging
+import os
+import random
+import subprocess
+import tempfile
+import time
+
+# dependency modules
+import nibabel
+import niix2bids
+import numpy as np
+
+# local modules
+import nifti2database
+
+
+# (SeriesDescription, PulseSequenceDetails, SequenceName, matrix, resolution (mm, and TR in s for 4D), extra fields)
+# 1 entry per dcm2niix series : a series can give several files (echoes), listed in 'files'
+PROTOCOL = [
+    {'description': 't1_mprage_sag_p2_iso', 'details': '%SiemensSeq%_tfl', 'sequence': '*tfl3d1_16ns',
+     'shape': (176, 256, 256), 'zooms': (1.0, 1.0, 1.0), 'acq': '3D', 'files': [{}],
+     'fields': {'RepetitionTime': 2.3, 'InversionTime': 0.9, 'EchoTime': 0.00296, 'FlipAngle': 9,
+                'ImageType': ['ORIGINAL', 'PRIMARY', 'M', 'ND', 'NORM']}},
+    {'description': 'mp2rage_INV1', 'details': '%CustomerSeq%_mp2rage', 'sequence': '*tfl3d1_16',
+     'shape': (176, 240, 256), 'zooms': (1.0, 1.0, 1.0), 'acq': '3D', 'files': [{}],
+     'fields': {'RepetitionTime': 5.0, 'InversionTime': 0.7, 'EchoTime': 0.00298, 'FlipAngle': 4,
+                'ImageType': ['ORIGINAL', 'PRIMARY', 'M', 'ND']}},
+    {'description': 'mp2rage_INV2', 'details': '%CustomerSeq%_mp2rage', 'sequence': '*tfl3d1_16',
+     'shape': (176, 240, 256), 'zooms': (1.0, 1.0, 1.0), 'acq': '3D', 'files': [{}],
+     'fields': {'RepetitionTime': 5.0, 'InversionTime': 2.5, 'EchoTime': 0.00298, 'FlipAngle': 5,
+                'ImageType': ['ORIGINAL', 'PRIMARY', 'M', 'ND']}},
+    {'description': 'mp2rage_UNI_Images', 'details': '%CustomerSeq%_mp2rage', 'sequence': '*tfl3d1_16',
+     'shape': (176, 240, 256), 'zooms': (1.0, 1.0, 1.0), 'acq': '3D', 'files': [{}],
+     'fields': {'RepetitionTime': 5.0, 'EchoTime': 0.00298, 'FlipAngle': 4,
+                'ImageType': ['DERIVED', 'PRIMARY', 'M', 'ND', 'UNI']}},
+    {'description': 'mp2rage_T1_Images', 'details': '%CustomerSeq%_mp2rage', 'sequence': '*tfl3d1_16',
+     'shape': (176, 240, 256), 'zooms': (1.0, 1.0, 1.0), 'acq': '3D', 'files': [{}],
+     'fields': {'RepetitionTime': 5.0, 'EchoTime': 0.00298, 'FlipAngle': 4,
+                'ImageType': ['DERIVED', 'PRIMARY', 'T1 MAP', 'ND']}},
+    {'description': 'gre_5echoes', 'details': '%SiemensSeq%_gre', 'sequence': '*fl3d5',
+     'shape': (192, 192, 128), 'zooms': (1.0, 1.0, 1.0), 'acq': '3D',
+     'files': [{'EchoNumber': e, 'EchoTime': round(0.004 + 0.0061*(e-1), 5)} for e in range(1, 6)],
+     'fields': {'RepetitionTime': 0.035, 'FlipAngle': 15, 'ImageType': ['ORIGINAL', 'PRIMARY', 'M', 'ND']}},
+    {'description': 'gre_5echoes', 'details': '%SiemensSeq%_gre', 'sequence': '*fl3d5', 'suffix': '_ph',
+     'shape': (192, 192, 128), 'zooms': (1.0, 1.0, 1.0), 'acq': '3D',
+     'files': [{'EchoNumber': e, 'EchoTime': round(0.004 + 0.0061*(e-1), 5)} for e in range(1, 6)],
+     'fields': {'RepetitionTime': 0.035, 'FlipAngle': 15, 'ImageType': ['ORIGINAL', 'PRIMARY', 'P', 'ND']}},
+    {'description': 'fmri_mb4_rest_SBRef', 'details': '%CustomerSeq%_cmrr_mbep2d_bold', 'sequence': 'epfid2d1_104',
+     'shape': (104, 104, 72), 'zooms': (2.0, 2.0, 2.0), 'acq': '2D', 'files': [{}],
+     'fields': {'RepetitionTime': 1.0, 'EchoTime': 0.03, 'FlipAngle': 62, 'MultibandAccelerationFactor': 4,
+                'PhaseEncodingDirection': 'j-', 'ImageType': ['ORIGINAL', 'PRIMARY', 'M', 'ND', 'MOSAIC']}},
+    {'description': 'fmri_mb4_rest', 'details': '%CustomerSeq%_cmrr_mbep2d_bold', 'sequence': 'epfid2d1_104',
+     'shape': (104, 104, 72, 600), 'zooms': (2.0, 2.0, 2.0, 1.0), 'acq': '2D', 'files': [{}],
+     'fields': {'RepetitionTime': 1.0, 'EchoTime': 0.03, 'FlipAngle': 62, 'MultibandAccelerationFactor': 4,
+                'PhaseEncodingDirection': 'j-', 'ImageType': ['ORIGINAL', 'PRIMARY', 'M', 'ND', 'MOSAIC']}},
+    {'description': 'gre_field_mapping', 'details': '%SiemensSeq%_gre_field_mapping', 'sequence': '*fm2d2r',
+     'shape': (104, 104, 72), 'zooms': (2.0, 2.0, 2.0), 'acq': '2D',
+     'files': [{'EchoNumber': 1, 'EchoTime': 0.00492}, {'EchoNumber': 2, 'EchoTime': 0.00738}],
+     'fields': {'RepetitionTime': 0.6, 'FlipAngle': 60, 'ImageType': ['ORIGINAL', 'PRIMARY', 'M', 'ND']}},
+    {'description': 'gre_field_mapping', 'details': '%SiemensSeq%_gre_field_mapping', 'sequence': '*fm2d2r', 'suffix': '_ph',
+     'shape': (104, 104, 72), 'zooms': (2.0, 2.0, 2.0), 'acq': '2D',
+     'files': [{'EchoNumber': 2, 'EchoTime1': 0.00492, 'EchoTime2': 0.00738}],
+     'fields': {'RepetitionTime': 0.6, 'FlipAngle': 60, 'ImageType': ['ORIGINAL', 'PRIMARY', 'P', 'ND']}},
+    {'description': 'dwi_mb3_b1000_b2000_64dir', 'details': '%CustomerSeq%_cmrr_mbep2d_diff', 'sequence': 'ep_b0',
+     'shape': (110, 110, 66, 129), 'zooms': (2.0, 2.0, 2.0, 3.4), 'acq': '2D', 'files': [{}], 'bval': True,
+     'fields': {'RepetitionTime': 3.4, 'EchoTime': 0.075, 'FlipAngle': 90, 'MultibandAccelerationFactor': 3,
+                'PhaseEncodingDirection': 'j-', 'ImageType': ['ORIGINAL', 'PRIMARY', 'DIFFUSION', 'NONE', 'ND', 'MOSAIC']}},
+]
+
+
+########################################################################################################################
+def write_nifti(path: str, shape: tuple, zooms: tuple, rng: random.Random) -> None:
+    # nifti-1 header, as written by dcm2niix, but without the voxel data
+
+    header = nibabel.Nifti1Header()
+    header.set_data_dtype(np.int16)
+    header.set_data_shape(shape)
+    header.set_zooms(zooms)
+    header.set_xyzt_units('mm', 'sec')
+    affine = np.diag(list(zooms[:3]) + [1.0])
+    affine[:3, 3] = [-zooms[i] * shape[i] / 2 + rng.uniform(-5, 5) for i in range(3)]
+    header.set_qform(affine, code=1)
+    header.set_sform(affine, code=1)
+    block = header.binaryblock + b'\x00' * 4  # empty extension flag, voxel data would start at vox_offset=352
+
+    if path.endswith('.gz'):
+        with gzip.open(path, 'wb') as fp:
+            fp.write(block)
+    else:
+        with open(path, 'wb') as fp:
+            fp.write(block)
+
+
+########################################################################################################################
+def get_sidecar(series: dict, file_fields: dict, session_idx: int, series_number: int, rng: random.Random,
+                acq_time: datetime.datetime) -> dict:
+    # the usual fields of a Siemens sidecar from dcm2niix
+
+    slice_timing = None
+    if series['acq'] == '2D':
+        n_slice = series['shape'][2]
+        mb = series['fields'].get('MultibandAccelerationFactor', 1)
+        tr = series['fields']['RepetitionTime']
+        n_shot = n_slice // mb
+        slice_timing = [round((idx % n_shot) * tr / n_shot, 4) for idx in range(n_slice)]
+
+    sidecar = {
+        'Modality': 'MR',
+        'MagneticFieldStrength': 3,
+        'ImagingFrequency': 123.2,
+        'Manufacturer': 'Siemens',
+        'ManufacturersModelName': 'Prisma_fit',
+        'InstitutionName': 'Institute',
+        'DeviceSerialNumber': '66000',
+        'StationName': 'AWP66000',
+        'SoftwareVersions': 'syngo MR E11',
+        'MRAcquisitionType': series['acq'],
+        'PatientName': f"SUBJ{session_idx:05d}",
+        'PatientID': f"ID{session_idx:05d}",
+        'PatientSex': rng.choice(['M', 'F']),
+        'PatientWeight': rng.randint(50, 100),
+        'StudyDescription': 'PROTOCOL^research',
+        'StudyInstanceUID': f"1.3.12.2.1107.5.2.43.66000.{session_idx}",
+        'SeriesDescription': series['description'],
+        'ProtocolName': series['description'],
+        'ScanningSequence': 'GR\\IR' if 'tfl' in series['sequence'] else 'EP' if 'ep' in series['sequence'] else 'GR',
+        'SequenceVariant': 'SK\\SP\\MP',
+        'ScanOptions': 'IR' if 'tfl' in series['sequence'] else 'FS',
+        'SequenceName': series['sequence'],
+        'PulseSequenceDetails': series['details'],
+        'PulseSequenceName': series['details'].split('_', 1)[1],  # as the Siemens XA (enhanced DICOM) sidecars
+        'ImageType': series['fields']['ImageType'],
+        'SeriesNumber': series_number,
+        'SeriesInstanceUID': f"1.3.12.2.1107.5.2.43.66000.{session_idx}.{series_number}",
+        'AcquisitionDateTime': (acq_time + datetime.timedelta(minutes=3*series_number)).isoformat(timespec='microseconds'),
+        'AcquisitionNumber': 1,
+        'SliceThickness': series['zooms'][2],
+        'SAR': round(rng.uniform(0.01, 0.5), 5),
+        'PartialFourier': 1,
+        'BaseResolution': series['shape'][1],
+        'ShimSetting': [rng.randint(-3000, 3000) for _ in range(8)],
+        'TxRefAmp': round(rng.uniform(200, 300), 3),
+        'PhaseResolution': 1,
+        'ReceiveCoilName': 'HeadNeck_64',
+        'ReceiveCoilActiveElements': 'HC1-7;NC1,2',
+        'CoilString': 'HC1-7;NC1,2',
+        'PercentPhaseFOV': 100,
+        'PercentSampling': 100,
+        'AcquisitionMatrixPE': series['shape'][1],
+        'ReconMatrixPE': series['shape'][1],
+        'PixelBandwidth': rng.choice([200, 240, 1814, 2290]),
+        'ImageOrientationPatientDICOM': [1, 0, 0, 0, 0.99863, -0.052336],
+        'InPlanePhaseEncodingDirectionDICOM': 'COL',
+        'ConversionSoftware': 'dcm2niix',
+        'ConversionSoftwareVersion': 'v1.0.20220720',
+    }
+    sidecar.update({key: value for key, value in series['fields'].items() if key != 'ImageType'})
+    sidecar.update(file_fields)
+    if slice_timing is not None:
+        sidecar['SliceTiming'] = slice_timing
+    return sidecar
+
+
+########################################################################################################################
+def generate_archive(root: str, n_session: int, seed: int = 0) -> int:
+    # returns the number of volumes (.nii with its .json)
+
+    rng = random.Random(seed)
+    n_volume = 0
+
+    for session_idx in range(n_session):
+
+        acq_time = datetime.datetime(2021, 1, 1, 8) + datetime.timedelta(days=session_idx // 8, hours=session_idx % 8)
+        session_dir = os.path.join(root, f"{acq_time:%Y_%m_%d}_SUBJ{session_idx:05d}")
+        os.makedirs(session_dir, exist_ok=True)
+
+        for series_number, series in enumerate(PROTOCOL, start=1):
+            for file_fields in series['files']:
+
+                # dcm2niix naming : s<SeriesNumber>_<SeriesDescription>[_e<EchoNumber>][_ph]
+                name = f"s{series_number:03d}_{series['description']}"
+                if len(series['files']) > 1:
+                    name += f"_e{file_fields['EchoNumber']}"
+                name += series.get('suffix', '')
+                path = os.path.join(session_dir, name)
+
+                ext = '.nii.gz' if rng.random() < 0.5 else '.nii'
+                write_nifti(path + ext, series['shape'], series['zooms'], rng)
+
+                sidecar = get_sidecar(series, file_fields, session_idx, series_number, rng, acq_time)
+                with open(path + '.json', 'w') as fp:
+                    json.dump(sidecar, fp, indent=4)
+
+                if series.get('bval'):
+                    n_dir = series['shape'][3]
+                    with open(path + '.bval', 'w') as fp:
+                        fp.write(' '.join(str(0 if idx % 16 == 0 else 1000 * (1 + idx % 2)) for idx in range(n_dir)) + '\n')
+                    with open(path + '.bvec', 'w') as fp:
+                        for _ in range(3):
+                            fp.write(' '.join(f"{rng.uniform(-1, 1):.6f}" for _ in range(n_dir)) + '\n')
+
+                n_volume += 1
+
+    return n_volume
+
+
+########################################################################################################################
+def get_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ''
+
+
+########################################################################################################################
+def run_once(args: argparse.Namespace, session_dirs: list[str], out_dir: str) -> dict:
+
+    cli_args = ['-i'] + session_dirs + ['-o', out_dir, '--workers', str(args.workers), '--jobs', str(args.jobs),
+                                        '--chunk_size', str(args.chunk_size)]
+    if args.config_file:
+        cli_args += ['--config_file', args.config_file]
+    if args.credentials:
+        cli_args += ['--connect', '--credentials', args.credentials]
+    else:
+        cli_args += ['--prepare']
+
+    workflow_args = nifti2database.cli.format_args(nifti2database.cli.get_parser().parse_args(cli_args))
+
+    metrics = {}
+    nifti2database.workflow.run(workflow_args, sysexit=False, metrics=metrics)
+    return metrics
+
+
+########################################################################################################################
+def print_metrics(metrics: dict, reference: dict = None) -> None:
+
+    counters = metrics['counters']
+    print(f"{'stage':<30} {'calls':>6} {'wall (s)':>10} {'cpu (s)':>10} {'rss (MB)':>10} {'delta (MB)':>10}" + (f" {'ref wall':>10} {'ratio':>7}" if reference else ''))
+    for name, stage in metrics['stages'].items():
+        line = f"{name:<30} {stage['calls']:>6} {stage['wall']:>10.3f} {stage['cpu']:>10.3f} {stage['rss_peak_mb']:>10.0f} {stage['rss_delta_mb']:>+10.0f}"
+        if reference:
+            ref_stage = reference['stages'].get(name)
+            if ref_stage and ref_stage['wall'] > 0:
+                line += f" {ref_stage['wall']:>10.3f} {stage['wall']/ref_stage['wall']:>6.2f}x"
+        print(line)
+
+    print(f"{'total':<30} {'':>6} {metrics['wall']:>10.3f} {metrics['cpu']:>10.3f} {metrics['rss_peak_mb']:>10.0f} {'':>10}"
+          + (f" {reference['wall']:>10.3f} {metrics['wall']/reference['wall']:>6.2f}x" if reference else ''))
+    print(f"volumes : {counters['volumes']:,} ({counters['volumes']/metrics['wall']:,.0f}/s) // "
+          f"scans : {counters['scans']:,} ({counters['scans']/metrics['wall']:,.0f}/s) // "
+          f"inserted : {counters['scans_inserted']:,} // JSON : {counters['bytes_sent']/1024**2:,.1f}MB "
+          f"({counters['bytes_sent']/1024**2/metrics['wall']:,.1f}MB/s)")
+
+
+########################################################################################################################
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description="Benchmark of the ingest pipeline on a synthetic archive")
+    parser.add_argument("--sessions"   , type=int, default=50, help="number of session directories to generate")
+    parser.add_argument("--seed"       , type=int, default=0)
+    parser.add_argument("--archive"    , default=None, help="generate the archive here, and keep it (default: temporary)")
+    parser.add_argument("--config_file", default=None)
+    parser.add_argument("--credentials", default=None, help="insert in this database, instead of '--prepare'")
+    parser.add_argument("--workers"    , type=int, default=1)
+    parser.add_argument("--jobs"       , type=int, default=1)
+    parser.add_argument("--chunk_size" , type=int, default=0)
+    parser.add_argument("--repeat"     , type=int, default=1)
+    parser.add_argument("--save"       , default=None, help="write the results in this JSON file")
+    parser.add_argument("--compare"    , default=None, help="JSON file of a previous --save, to compare with")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='nifti2database_bench_') as tmp_dir:
+
+        archive = args.archive or os.path.join(tmp_dir, 'archive')
+        out_dir = os.path.join(tmp_dir, 'out')
+        os.makedirs(out_dir)
+
+        existing = sorted(os.listdir(archive)) if os.path.isdir(archive) else []
+        if len(existing) != args.sessions:
+            start_time = time.perf_counter()
+            n_volume = generate_archive(archive, args.sessions, args.seed)
+            print(f"archive : {archive} : {args.sessions:,} sessions, {n_volume:,} volumes, "
+                  f"generated in {time.perf_counter() - start_time:.1f}s")
+        else:
+            print(f"archive : {archive} : reusing {len(existing):,} sessions")
+        session_dirs = sorted(os.path.join(archive, name) for name in os.listdir(archive))
+
+        reference = None
+        if args.compare:
+            with open(args.compare) as fp:
+                reference = json.load(fp)['runs'][0]
+            print(f"compared with : {args.compare}")
+
+        runs = []
+        for idx in range(args.repeat):
+            # a new log file for each run, the '--prepare' file is written next to it
+            # the console only gets the warnings of the pipeline, and the results
+            niix2bids.utils.init_logger(write_file=True, out_dir=out_dir)
+            logging.getLogger().handlers[0].setLevel(logging.WARNING)
+            metrics = run_once(args, session_dirs, out_dir)
+            print(f"\nrun {idx+1}/{args.repeat} : {'--connect' if args.credentials else '--prepare'}")
+            print_metrics(metrics, reference if idx == 0 else None)
+            runs.append(metrics)
+
+    if args.save:
+        results = {
+            'commit'  : get_commit(),
+            'date'    : datetime.datetime.now().isoformat(timespec='seconds'),
+            'sessions': args.sessions,
+            'options' : {key: getattr(args, key) for key in ('workers', 'jobs', 'chunk_size', 'seed')}
+                        | {'mode': 'connect' if args.credentials else 'prepare'},
+            'runs'    : runs,
+        }
+        with open(args.save, 'w') as fp:
+            json.dump(results, fp, indent=4)
+        print(f"\nresults saved in : {args.save}")
+
+
+if __name__ == "__main__":
+    main()
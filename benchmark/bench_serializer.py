@@ -0,0 +1,161 @@
+# Benchmark of the scan serialization : clean the values of each scan, and dump it to a JSON str for the database
+# Compare the former implementation (several passes over each scan + json.dumps + str.replace), kept here as reference,
+# with the current one (single pass type dispatch, with the json and the optional orjson backends).
+#
+# Usage : python benchmark/bench_serializer.py [--scans 20000] [--columns 200]
+
+# standard modules
+import argparse
+import json
+import time
+import types
+
+# dependency modules
+import niix2bids
+import numpy as np
+
+# local modules
+import nifti2database
+
+
+########################################################################################################################
+def legacy_serialize_scan(scan: dict) -> tuple[str, str, str]:
+
+    scan_clean = scan.copy()
+
+    # change Volume objects to a standard path str
+    if type(scan['Volume']) is niix2bids.classes.Volume:
+        scan_clean['Volume'] = scan['Volume'].nii.path
+    else: # its a list[Volume]
+        path_list = []
+        for vol in scan['Volume']:
+            path_list.append(vol.nii.path)
+        scan_clean['Volume'] = path_list
+
+    # this function will convert scalar
+    def int_or_round3__scalar(scalar):
+        if (type(scalar) is np.float64 or type(scalar) is float) and np.isnan(scalar):
+            return scalar
+        scalar = float(scalar)  # conversion to the builtin float to avoid numpy.float64
+        scalar = round(scalar) if round(scalar) == round(scalar,3) else round(scalar,3)
+        return scalar
+
+    # this function will 'apply int_or_round3__scalar' on each element or sub-element
+    def int_or_round3(input):
+        if type(input) == np.float64 or type(input) == np.float32:  # this is a scalar
+            return int_or_round3__scalar(input)
+        else:  # tuple ? list[tuple] ?
+            output_list = []
+            for elem in input:
+                if type(elem) is tuple:  # tuple
+                    output_list.append( tuple(map(int_or_round3__scalar,elem)) )
+                else:
+                    output_list.append( int_or_round3__scalar(elem) )
+            return output_list
+
+    for key in ['Mx', 'My', 'Mz', 'Mt', 'Rx', 'Ry', 'Rz', 'Rt', 'Fx', 'Fy', 'Fz', 'Ft', 'Matrix', 'Resolution', 'FoV']:
+        if key in scan_clean.keys():
+            scan_clean[key] = int_or_round3(scan_clean[key])
+
+    if 'run' not in scan_clean.keys():
+        scan_clean['run'] = np.nan
+    else:
+        scan_clean['run'] = int(scan_clean['run'])
+
+    for key in scan_clean.keys():
+        if type(scan_clean[key]) is np.float64 and scan_clean[key] == int(scan_clean[key]):
+            scan_clean[key] = int(scan_clean[key])
+
+    for key in scan_clean.keys():
+        if type(scan_clean[key]) is np.bool_:
+            scan_clean[key] = bool(scan_clean[key])
+
+    dict_str = json.dumps(scan_clean)
+    dict_str = dict_str.replace('NaN', '"NaN"')
+
+    first_SeriesInstanceUID = scan_clean['SeriesInstanceUID'] if type(scan_clean['SeriesInstanceUID']) is str else scan_clean['SeriesInstanceUID'][0]
+    patient_id = scan_clean['AcquisitionDateTime'].split('T')[0].replace('-','_') + "_" + scan_clean['PatientName']
+
+    return dict_str, first_SeriesInstanceUID, patient_id
+
+
+########################################################################################################################
+def make_scans(n_scan: int, n_column: int, seed: int = 0) -> list[dict]:
+
+    rng = np.random.default_rng(seed)
+
+    # values like the ones from build_scan_from_series : numpy scalars for the constant fields, lists for the others
+    scans = []
+    for idx in range(n_scan):
+        n_vol = int(rng.integers(1, 4))
+        scan = {
+            'Volume'             : [types.SimpleNamespace(nii=types.SimpleNamespace(path=f"/archive/{idx}/vol_{v}.nii")) for v in range(n_vol)],
+            'PatientName'        : f"SUBJ{idx//20}",
+            'SeriesInstanceUID'  : [f"1.3.12.2.{idx}.{v}" for v in range(n_vol)] if n_vol > 1 else f"1.3.12.2.{idx}",
+            'AcquisitionDateTime': '2021-10-25T09:36:22.535000',
+            'Mx'                 : np.float64(176.0),
+            'Rx'                 : np.float64(rng.random()),
+            'Matrix'             : [(176, 256, 256)] * n_vol,
+            'Resolution'         : [tuple(np.float32(rng.random(3)))] * n_vol,
+            'FoV'                : [tuple(rng.random(3) * 256)] * n_vol,
+            'run'                : np.float64(1 + idx % 3),
+        }
+        for col in range(n_column):
+            kind = col % 4
+            if kind == 0:
+                scan[f"Field{col:03d}"] = np.float64(rng.random())
+            elif kind == 1:
+                scan[f"Field{col:03d}"] = np.float64(rng.integers(0, 1000))
+            elif kind == 2:
+                scan[f"Field{col:03d}"] = f"value_{rng.integers(0, 50)}"
+            else:
+                scan[f"Field{col:03d}"] = [float(v) for v in rng.random(n_vol)]
+        scan['MTC'] = np.bool_(idx % 2)
+        if idx % 10 == 0:  # NaN nested in a list, next to finite numpy floats : the fallback path of dumps()
+            scan['EchoTime'] = [np.float64(rng.random()), np.nan, np.float64(0.5)]
+        scans.append(scan)
+
+    return scans
+
+
+########################################################################################################################
+def run_serializer(scans: list[dict], serialize_scan) -> tuple[list[tuple[str, str, str]], float]:
+    start_time = time.perf_counter()
+    rows = [serialize_scan(scan) for scan in scans]
+    return rows, time.perf_counter() - start_time
+
+
+########################################################################################################################
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description="Benchmark of the scan serialization of nifti2database")
+    parser.add_argument("--scans"  , type=int, default=20_000, help="number of scans")
+    parser.add_argument("--columns", type=int, default=200   , help="number of JSON fields")
+    args = parser.parse_args()
+
+    scans = make_scans(args.scans, args.columns)
+
+    rows_old, t_old = run_serializer(scans, legacy_serialize_scan)
+
+    orjson = nifti2database.serializer.orjson
+    nifti2database.serializer.orjson = None
+    rows_json, t_json = run_serializer(scans, nifti2database.serializer.serialize_scan)
+    nifti2database.serializer.orjson = orjson
+    assert rows_json == rows_old  # same text with the json backend
+
+    n_scan = len(scans)
+    print(f"{'backend':>10} {'time (s)':>10} {'us/scan':>10} {'speedup':>8}")
+    print(f"{'legacy':>10} {t_old :>10.2f} {1e6*t_old /n_scan:>10.1f} {'-':>8}")
+    print(f"{'json':>10} {t_json:>10.2f} {1e6*t_json/n_scan:>10.1f} {t_old/t_json:>7.1f}x")
+
+    if orjson is not None:
+        rows_orjson, t_orjson = run_serializer(scans, nifti2database.serializer.serialize_scan)
+        assert [(json.loads(row[0]), row[1], row[2]) for row in rows_orjson] == \
+               [(json.loads(row[0]), row[1], row[2]) for row in rows_old]  # same content, more compact text
+        print(f"{'orjson':>10} {t_orjson:>10.2f} {1e6*t_orjson/n_scan:>10.1f} {t_old/t_orjson:>7.1f}x")
+    else:
+        print(f"{'orjson':>10} {'not installed':>10}")
+
+
+if __name__ == "__main__":
+    main()
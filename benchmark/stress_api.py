@@ -0,0 +1,120 @@
+# Stress test of the API : many requests at the same time, each one must get a correct and separate report
+# Each directory is sent as 1 request, --repeat times, all in parallel, using the Flask test client.
+# A report is correct if it is complete, if it only mentions its own directory, and if it counts the volumes of its
+# own directory only.
+#
+# Usage : python benchmark/stress_api.py -i /path/to/session1 /path/to/session2 ... --credentials FILE
+#                                        [--config_file FILE] [--repeat 4] [--route /nifti2database]
+#
+# !! it runs in --connect mode : the scans of the directories are inserted in the database of the credentials file !!
+
+# standard modules
+import argparse
+import concurrent.futures
+import json
+import os
+import re
+import time
+
+# dependency modules
+
+# local modules
+import nifti2database.api.main
+
+
+########################################################################################################################
+def count_volumes(in_dir: str) -> int:
+    # .nii files with their .json, like niix2bids does
+    n_volume = 0
+    for root, _, files in os.walk(in_dir):
+        for file in files:
+            if file.endswith('.nii') or file.endswith('.nii.gz'):
+                json_file = re.sub(r'\.nii(\.gz)?$', '.json', file)
+                n_volume += os.path.exists(os.path.join(root, json_file))
+    return n_volume
+
+
+########################################################################################################################
+def send_request(route: str, args_str: str) -> dict:
+
+    client = nifti2database.api.main.app.test_client()
+
+    if route == '/jobs':
+        job = json.loads(client.post('/jobs', json={'args': args_str}).data)
+        while True:
+            info = json.loads(client.get(f"/jobs/{job['job_id']}").data)
+            if info['status'] in ('done', 'failed'):
+                return info
+            time.sleep(0.05)
+
+    return json.loads(client.post(route, json={'args': args_str}).data)
+
+
+########################################################################################################################
+def check_report(info: dict, in_dir: str, all_dirs: list[str], n_volume: int) -> list[str]:
+
+    errors = []
+    report = info['report']
+
+    if not (info['success'] and info['complete']):
+        errors.append("run not complete")
+
+    if report.count("Total execution time is") != 1:
+        errors.append(f"{report.count('Total execution time is')} runs in the report")
+
+    if f"in_dir  : ['{in_dir}']" not in report:
+        errors.append("in_dir of the request not in the report")
+
+    for other_dir in all_dirs:
+        if other_dir != in_dir and other_dir + os.sep in report:
+            errors.append(f"report mentions another directory : {other_dir}")
+
+    match = re.search(r"nVolume=([\d,]+)", report)
+    if match and int(match.group(1).replace(',', '')) != n_volume:
+        errors.append(f"nVolume={match.group(1)} instead of {n_volume}")
+
+    return errors
+
+
+########################################################################################################################
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description="Stress test of the nifti2database API")
+    parser.add_argument("-i", "--in_dir"     , nargs='+', required=True, help="1 request per directory")
+    parser.add_argument("--credentials"      , required=True)
+    parser.add_argument("--config_file"      , default=None)
+    parser.add_argument("--repeat"           , type=int, default=4, help="number of requests per directory")
+    parser.add_argument("--route"            , default='/nifti2database', choices=['/nifti2database', '/jobs'])
+    args = parser.parse_args()
+
+    all_dirs = [os.path.abspath(in_dir) for in_dir in args.in_dir]
+    expected = {in_dir: count_volumes(in_dir) for in_dir in all_dirs}
+
+    requests = []
+    for _ in range(args.repeat):
+        for in_dir in all_dirs:
+            args_str = f"-i {in_dir} --credentials {args.credentials}"
+            if args.config_file:
+                args_str += f" --config_file {args.config_file}"
+            if args.route == '/jobs':
+                args_str += f" --chunk_size {len(requests)+1}"  # identical jobs would be deduplicated
+            requests.append((in_dir, args_str))
+
+    start_time = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(requests)) as executor:
+        infos = list(executor.map(lambda request: send_request(args.route, request[1]), requests))
+    elapsed = time.perf_counter() - start_time
+
+    n_error = 0
+    for (in_dir, _), info in zip(requests, infos):
+        errors = check_report(info, in_dir, all_dirs, expected[in_dir])
+        n_error += len(errors)
+        for error in errors:
+            print(f"{in_dir} : {error}")
+
+    print(f"{len(requests)} parallel requests in {elapsed:.2f}s : {n_error} errors")
+    raise SystemExit(1 if n_error else 0)
+
+
+if __name__ == "__main__":
+    main()
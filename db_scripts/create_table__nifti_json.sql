@@ -3,9 +3,34 @@ CREATE TABLE nifti2database_schema.nifti_json (
 	suid varchar(128) NOT NULL,
 	patient_id varchar(128) NOT NULL,
 	insertion_time timestamptz NOT NULL,
+	-- copied from dict at insertion, see nifti2database/schema.py
+	pulse_sequence_name text,
+	suffix text,
+	tag text,
+	protocol_name text,
+	acquisition_date_time text,
+	patient_name text,
+	rx double precision,
+	ry double precision,
+	rz double precision,
 	CONSTRAINT nifti_json_pk PRIMARY KEY (suid)
 );
 
+-- containment queries on any key : dict @> '{"PulseSequenceName": "tfl"}'
+CREATE INDEX nifti_json_dict_path_ops_idx ON nifti2database_schema.nifti_json USING gin (dict jsonb_path_ops);
+
+CREATE INDEX nifti_json_pulse_sequence_name_idx ON nifti2database_schema.nifti_json (pulse_sequence_name);
+CREATE INDEX nifti_json_suffix_idx ON nifti2database_schema.nifti_json (suffix);
+CREATE INDEX nifti_json_tag_idx ON nifti2database_schema.nifti_json (tag);
+CREATE INDEX nifti_json_protocol_name_idx ON nifti2database_schema.nifti_json (protocol_name);
+CREATE INDEX nifti_json_acquisition_date_time_idx ON nifti2database_schema.nifti_json (acquisition_date_time);
+CREATE INDEX nifti_json_patient_name_idx ON nifti2database_schema.nifti_json (patient_name);
+CREATE INDEX nifti_json_rx_idx ON nifti2database_schema.nifti_json (rx);
+CREATE INDEX nifti_json_ry_idx ON nifti2database_schema.nifti_json (ry);
+CREATE INDEX nifti_json_rz_idx ON nifti2database_schema.nifti_json (rz);
+
+-- an existing table is migrated with : nifti2database schema --credentials FILE
+
 GRANT ALL ON TABLE nifti2database_schema.nifti_json TO nifti2database_app;
 
 select * from nifti2database_schema.nifti_json;
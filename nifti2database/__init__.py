@@ -1,4 +1,11 @@
 from nifti2database import workflow
 from nifti2database import utils
+from nifti2database import cache
+from nifti2database import config
+from nifti2database import serializer
+from nifti2database import schema
+from nifti2database import metrics
+from nifti2database import profiling
 from nifti2database import cli
+from nifti2database import watch
 from nifti2database import metadata
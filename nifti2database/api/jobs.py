@@ -0,0 +1,180 @@
+# standard modules
+import argparse            # just for function signature
+import concurrent.futures  # pool of job workers
+import json                # key of a job
+import os                  # environment variables & paths
+import threading           # the API serves requests in threads
+import time                # timing of the jobs
+import typing              # just for function signature
+import uuid                # job id
+
+# dependency modules
+import psycopg2.pool
+
+# local modules
+import nifti2database
+import nifti2database.api.pool
+
+
+# number of jobs executed at the same time
+JOB_WORKERS = int(os.environ.get('NIFTI2DATABASE_JOB_WORKERS', 2))
+
+# maximum number of jobs queued or running : above it, new jobs are rejected
+JOB_QUEUE_SIZE = int(os.environ.get('NIFTI2DATABASE_JOB_QUEUE_SIZE', 100))
+
+# number of finished jobs kept for GET /jobs/<id>
+JOB_HISTORY = int(os.environ.get('NIFTI2DATABASE_JOB_HISTORY', 1000))
+
+########################################################################################################################
+def execute(args: argparse.Namespace, progress: typing.Callable[[int, int], None] = None,
+            results: list[dict] = None, metrics: dict = None, profile: dict = None) -> tuple[bool, bool, str]:
+    # run the workflow as the API does : returns (success, complete, report)
+    # results, metrics, profile : see nifti2database.workflow.run()
+    # each run has its own volumes and its own report, so several runs can execute at the same time
+    # raises psycopg2.pool.PoolError when no pooled connection is free in time : the run did not start
+
+    nifti2database.utils.start_report_capture()
+
+    report = ""
+    success = False
+    complete = False
+    try :
+        if args.connect_or_prepare == "connect" and os.path.exists(args.credentials):
+            # reuse the connections across requests, instead of a new connection for each request
+            with nifti2database.api.pool.connection(args.credentials) as database:
+                report = nifti2database.workflow.run(args=args, sysexit=False, database=database,
+                                                     progress=progress, results=results, metrics=metrics,
+                                                     profile=profile)
+        else:
+            report = nifti2database.workflow.run(args=args, sysexit=False, progress=progress, results=results,
+                                                 metrics=metrics, profile=profile)
+        success = True
+        complete = 'Total execution time is' in report
+    except psycopg2.pool.PoolError:
+        raise
+    except:
+        report = nifti2database.utils.get_report()
+    finally:
+        nifti2database.utils.stop_report_capture()
+
+    return success, complete, report
+
+
+########################################################################################################################
+class Job:
+
+    def __init__(self, key: str, args: argparse.Namespace, req_dict: dict, args_list: list[str], batch: bool = False):
+        self.id          = uuid.uuid4().hex
+        self.key         = key
+        self.args        = args
+        self.req_dict    = req_dict
+        self.args_list   = args_list
+        self.status      = 'queued'  # queued -> running -> done | failed
+        self.progress    = 0.0
+        self.success     = False
+        self.complete    = False
+        self.report      = ""
+        self.results     = [] if batch else None  # per-directory results of a batch
+        self.metrics     = {}
+        self.profile     = {}  # 'report' of the profiler, with '--profile'
+        self.submit_time = time.time()
+        self.start_time  = None
+        self.end_time    = None
+
+    def set_progress(self, nDone: int, nTotal: int) -> None:
+        self.progress = nDone / nTotal
+
+    def to_dict(self) -> dict:
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'progress': self.progress,
+            'success': self.success,
+            'complete': self.complete,
+            'submit_time': self.submit_time,
+            'start_time': self.start_time,
+            'end_time': self.end_time,
+            'input_request_dict': self.req_dict,
+            'input_args_list': self.args_list,
+            'args': vars(self.args),
+            'report': self.report,
+            'metrics': self.metrics,
+            'profile': self.profile.get('report'),
+        } | ({} if self.results is None else get_batch_summary(self.results))
+
+
+jobs     = {}  # id -> Job, in submission order
+inflight = {}  # key -> Job, queued or running
+jobs_lock = threading.Lock()
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='nifti2database_job')
+
+
+########################################################################################################################
+def get_batch_summary(results: list[dict]) -> dict:
+    # 1 result per directory (the batch runs with 1 directory per chunk), and the totals
+    directories = [stats | {'in_dir': stats['in_dir'][0]} for stats in results]
+    total = {key: sum(stats[key] for stats in results)
+             for key in nifti2database.metrics.COUNTERS}
+    total['errors'] = sum(stats['error'] is not None for stats in results)
+    return {'results': directories, 'total': total}
+
+
+########################################################################################################################
+def get_job_key(args: argparse.Namespace) -> str:
+    # identical requests have the same parsed args, whatever the order of the options
+    args_dict = vars(args).copy()
+    args_dict['in_dir'] = sorted(args_dict['in_dir'])
+    return json.dumps(args_dict, sort_keys=True, default=str)
+
+
+########################################################################################################################
+def submit(args: argparse.Namespace, req_dict: dict, args_list: list[str], batch: bool = False) -> tuple[Job, bool]:
+    # returns (job, deduplicated) : the job is None if the queue is full
+
+    key = get_job_key(args) + ('batch' if batch else '')
+
+    with jobs_lock:
+
+        if key in inflight:
+            return inflight[key], True
+
+        if len(inflight) >= JOB_QUEUE_SIZE:
+            return None, False
+
+        job = Job(key, args, req_dict, args_list, batch)
+        jobs[job.id] = job
+        inflight[key] = job
+
+        # forget the oldest finished jobs
+        finished = [job_id for job_id, old_job in jobs.items() if old_job.status in ('done', 'failed')]
+        for job_id in finished[:max(len(finished) - JOB_HISTORY, 0)]:
+            del jobs[job_id]
+
+    executor.submit(run_job, job)
+
+    return job, False
+
+
+########################################################################################################################
+def run_job(job: Job) -> None:
+
+    try:
+        job.status     = 'running'
+        job.start_time = time.time()
+        job.success, job.complete, job.report = execute(job.args, job.set_progress, job.results, job.metrics,
+                                                               job.profile)
+    except psycopg2.pool.PoolError as exc:
+        job.report = str(exc)
+    finally:
+        job.end_time = time.time()
+        job.status   = 'done' if job.success and job.complete else 'failed'
+        if job.status == 'done':
+            job.progress = 1.0
+        with jobs_lock:
+            del inflight[job.key]
+
+
+########################################################################################################################
+def get_job(job_id: str) -> Job:
+    with jobs_lock:
+        return jobs.get(job_id)
@@ -1,13 +1,20 @@
 # standard modules
+import argparse        # just for function signature
 import flask           # html interface
+import functools       # cached parser
 import json            # load, dump
 import os              # join paths
 
 # dependency modules
 import niix2bids
+import psycopg2
+import psycopg2.pool
 
 # local modules
 import nifti2database
+import nifti2database.api.jobs
+import nifti2database.api.pool
+import nifti2database.api.query
 
 
 # initialization of the app
@@ -20,6 +27,12 @@ niix2bids.utils.init_logger(write_file=False, out_dir='',
                             store_report=True)  # this "report" is the output of the logger stored in a string
 
 
+@functools.cache
+def get_parser() -> argparse.ArgumentParser:
+    # the parser is built once for the whole process : parse_args() does not modify it
+    return nifti2database.cli.get_parser()
+
+
 def render_string(string: str) -> str:
     return flask.render_template('display_string.html', string=string)
 
@@ -31,15 +44,13 @@ def index() -> str:
 
 @app.route('/help')
 def get_help() -> str:
-    parser = nifti2database.cli.get_parser()
+    parser = get_parser()
     help_str = parser.format_help()
     return render_string(help_str)
 
 
-@app.route('/nifti2database',methods=['POST'])
-def run():
-
-    req_dict = flask.request.get_json()
+def parse_request(req_dict: dict) -> tuple[argparse.Namespace, list[str], dict]:
+    # returns (args, args_list, None), or (None, None, info) with the reason of the failure
 
     if not req_dict:
         info = {
@@ -47,7 +58,7 @@ def run():
             'input_request_dict': req_dict,
             'reason': 'empty JSON'
         }
-        return json.dumps(info), 200, {'ContentType': 'application/json'}
+        return None, None, info
 
     if 'args' not in req_dict:
         info = {
@@ -55,7 +66,7 @@ def run():
             'input_request_dict': req_dict,
             'reason': '"args" key not in JSON'
         }
-        return json.dumps(info), 200, {'ContentType': 'application/json'}
+        return None, None, info
 
     if type(req_dict['args']) is not str:
         info = {
@@ -63,10 +74,10 @@ def run():
             'input_request_dict': req_dict,
             'reason': '"args" is not a string'
         }
-        return json.dumps(info), 200, {'ContentType': 'application/json'}
+        return None, None, info
 
     args_list = req_dict['args'].split(' ')
-    parser = nifti2database.cli.get_parser()
+    parser = get_parser()
     try:
         args = parser.parse_args(args_list)
     except SystemExit:
@@ -76,19 +87,46 @@ def run():
             'reason': '"args" => bad syntax',
             'usage': parser.format_usage(),
         }
-        return json.dumps(info), 200, {'ContentType': 'application/json'}
+        return None, None, info
 
-    niix2bids.classes.Volume.instances = []  # we absolutely need to flush all instances
+    # "profile": true (or N) is the same as '--profile' (or '--profile N') in "args"
+    profile = req_dict.get('profile') or args.profile
+    try:
+        profile = int(profile)
+    except (TypeError, ValueError, OverflowError):  # OverflowError : 1.5e400 is read as inf
+        profile = -1
+    if profile < 0:
+        info = {
+            'success': False,
+            'input_request_dict': req_dict,
+            'reason': '"profile" is not a boolean or a positive integer'
+        }
+        return None, None, info
+    args.profile = profile
 
-    report = ""
-    success = False
-    complete = False
-    try :
-        report = nifti2database.workflow.run(args=args, sysexit=False)
-        success = True
-        complete = 'Total execution time is' in report
-    except:
-        report = nifti2database.utils.get_report()
+    return args, args_list, None
+
+
+@app.route('/nifti2database',methods=['POST'])
+def run():
+
+    req_dict = flask.request.get_json()
+
+    args, args_list, info = parse_request(req_dict)
+    if info is not None:
+        return json.dumps(info), 200, {'ContentType': 'application/json'}
+
+    metrics = {}
+    profile = {}
+    try:
+        success, complete, report = nifti2database.api.jobs.execute(args, metrics=metrics, profile=profile)
+    except psycopg2.pool.PoolError as exc:
+        info = {
+            'success': False,
+            'input_request_dict': req_dict,
+            'reason': str(exc),
+        }
+        return json.dumps(info), 200, {'ContentType': 'application/json'}
 
     info = {
         'success': success,
@@ -97,10 +135,181 @@ def run():
         'input_args_list': args_list,
         'args': vars(args),
         'report': report,
+        'metrics': metrics,
+        'profile': profile.get('report'),
     }
     return json.dumps(info), 200, {'ContentType': 'application/json'}
 
 
+@app.route('/jobs',methods=['POST'])
+def submit_job():
+    # same JSON as /nifti2database, but the run is queued : the response only contains the job id
+
+    req_dict = flask.request.get_json()
+
+    args, args_list, info = parse_request(req_dict)
+    if info is not None:
+        return json.dumps(info), 200, {'ContentType': 'application/json'}
+
+    job, deduplicated = nifti2database.api.jobs.submit(args, req_dict, args_list)
+    if job is None:
+        info = {
+            'success': False,
+            'input_request_dict': req_dict,
+            'reason': 'job queue is full'
+        }
+        return json.dumps(info), 200, {'ContentType': 'application/json'}
+
+    info = {
+        'success': True,
+        'job_id': job.id,
+        'status': job.status,
+        'deduplicated': deduplicated,
+    }
+    return json.dumps(info), 200, {'ContentType': 'application/json'}
+
+
+@app.route('/batch',methods=['POST'])
+def run_batch():
+    # many directories in 1 request : the config, the connection and the parser are set up once,
+    # then each directory goes through the pipeline on its own, and gets its own result
+    # {"in_dir": ["/path/to/session1", "/path/to/session2"], "args": "<other args of the CLI>", "async": false,
+    #  "profile": false}
+
+    req_dict = flask.request.get_json()
+
+    if not req_dict or type(req_dict.get('in_dir')) is not list or len(req_dict['in_dir']) == 0 \
+            or not all(type(in_dir) is str and len(in_dir) > 0 for in_dir in req_dict['in_dir']):
+        info = {
+            'success': False,
+            'input_request_dict': req_dict,
+            'reason': '"in_dir" is not a non-empty list of non-empty strings'
+        }
+        return json.dumps(info), 200, {'ContentType': 'application/json'}
+
+    # only "args" is split on spaces : the directories are taken as they are, since a path can contain a space
+    args_str = ' '.join(['-i', 'in_dir'] + ([req_dict['args']] if req_dict.get('args') else []))
+    args, args_list, info = parse_request({'args': args_str, 'profile': req_dict.get('profile')})
+    if info is not None:
+        info['input_request_dict'] = req_dict
+        return json.dumps(info), 200, {'ContentType': 'application/json'}
+    args.in_dir = list(req_dict['in_dir'])
+    args_list = ['-i'] + args.in_dir + args_list[2:]
+    args.chunk_size = 1  # 1 result per directory
+
+    if req_dict.get('async'):
+        job, deduplicated = nifti2database.api.jobs.submit(args, req_dict, args_list, batch=True)
+        if job is None:
+            info = {
+                'success': False,
+                'input_request_dict': req_dict,
+                'reason': 'job queue is full'
+            }
+            return json.dumps(info), 200, {'ContentType': 'application/json'}
+        info = {
+            'success': True,
+            'job_id': job.id,
+            'status': job.status,
+            'deduplicated': deduplicated,
+        }
+        return json.dumps(info), 200, {'ContentType': 'application/json'}
+
+    results = []
+    metrics = {}
+    profile = {}
+    try:
+        success, complete, report = nifti2database.api.jobs.execute(args, results=results, metrics=metrics,
+                                                                    profile=profile)
+    except psycopg2.pool.PoolError as exc:
+        info = {
+            'success': False,
+            'input_request_dict': req_dict,
+            'reason': str(exc),
+        }
+        return json.dumps(info), 200, {'ContentType': 'application/json'}
+
+    info = {
+        'success': success,
+        'complete': complete,
+        'input_request_dict': req_dict,
+        'input_args_list': args_list,
+        'args': vars(args),
+        'report': report,
+        'metrics': metrics,
+        'profile': profile.get('report'),
+    } | nifti2database.api.jobs.get_batch_summary(results)
+    return json.dumps(info), 200, {'ContentType': 'application/json'}
+
+
+@app.route('/query',methods=['POST'])
+def run_query():
+    # read-only queries on the table, without writing SQL
+    # {"credentials": "/path/to/credentials.json",
+    #  "where": [{"key": "PulseSequenceName", "op": "=", "value": "tfl"}],
+    #  "group_by": ["Resolution"], "aggregate": [["avg", "RepetitionTime"]], "limit": 100}
+
+    req_dict = flask.request.get_json()
+
+    try:
+        query = nifti2database.api.query.parse_query(req_dict)
+    except ValueError as exc:
+        info = {
+            'success': False,
+            'input_request_dict': req_dict,
+            'reason': str(exc),
+        }
+        return json.dumps(info), 200, {'ContentType': 'application/json'}
+
+    try:
+        # the pool is opened here, so a bad credentials file is reported before the stream starts
+        nifti2database.api.pool.get_pool(query['credentials'])
+        if query['stream']:
+            return flask.Response(nifti2database.api.query.stream(query), mimetype='application/x-ndjson')
+        result, cached = nifti2database.api.query.execute(query)
+    except psycopg2.Error as exc:
+        info = {
+            'success': False,
+            'input_request_dict': req_dict,
+            'reason': str(exc).strip(),
+        }
+        return json.dumps(info), 200, {'ContentType': 'application/json'}
+    except (OSError, ValueError, KeyError) as exc:  # credentials file : unreadable, not JSON, missing key
+        info = {
+            'success': False,
+            'input_request_dict': req_dict,
+            'reason': f'"credentials" file is not valid : {type(exc).__name__}: {exc}',
+        }
+        return json.dumps(info), 200, {'ContentType': 'application/json'}
+
+    info = {
+        'success': True,
+        'input_request_dict': req_dict,
+        'cached': cached,
+    } | result
+    return json.dumps(info), 200, {'ContentType': 'application/json'}
+
+
+@app.route('/metrics',methods=['GET'])
+def get_metrics():
+    # totals of all the runs of this process, in the text format of Prometheus
+    return nifti2database.metrics.render_prometheus(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+
+@app.route('/jobs/<job_id>',methods=['GET'])
+def get_job(job_id: str):
+
+    job = nifti2database.api.jobs.get_job(job_id)
+    if job is None:
+        info = {
+            'success': False,
+            'job_id': job_id,
+            'reason': 'unknown job id'
+        }
+        return json.dumps(info), 200, {'ContentType': 'application/json'}
+
+    return json.dumps(job.to_dict()), 200, {'ContentType': 'application/json'}
+
+
 if __name__ == "__main__":
     # options bellow are useful for debugging
     # but on production, options are set by the caller, such as the docker container
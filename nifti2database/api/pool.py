@@ -0,0 +1,114 @@
+# standard modules
+import atexit          # close the connections when the API stops
+import contextlib      # connection() context manager
+import os              # environment variables & paths
+import threading       # the API serves requests in threads
+import time            # idle time of the connections
+
+# dependency modules
+import niix2bids
+import psycopg2
+import psycopg2.pool
+
+# local modules
+import nifti2database
+
+
+# limits of each pool, 1 pool per credentials file
+MINCONN = int(os.environ.get('NIFTI2DATABASE_POOL_MINCONN', 1))
+MAXCONN = int(os.environ.get('NIFTI2DATABASE_POOL_MAXCONN', 4))
+
+# maximum wait for a free connection : above it, the request fails with "database pool exhausted"
+TIMEOUT = float(os.environ.get('NIFTI2DATABASE_POOL_TIMEOUT', 30))
+
+# a connection idle for longer than this is checked with a "SELECT 1" before being reused
+HEALTH_CHECK_INTERVAL = float(os.environ.get('NIFTI2DATABASE_POOL_HEALTH_CHECK_INTERVAL', 30))
+
+
+########################################################################################################################
+def is_healthy(con: psycopg2.extensions.connection) -> bool:
+    if con.closed:
+        return False
+    try:
+        with con.cursor() as cur:
+            cur.execute("SELECT 1;")
+        con.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+########################################################################################################################
+class DatabasePool:
+    # psycopg2 ThreadedConnectionPool raises PoolError when it is exhausted : the semaphore makes the callers wait instead,
+    # up to TIMEOUT, so a stuck run cannot block all the requests forever
+
+    def __init__(self, credentials: str):
+        cred_dic        = nifti2database.utils.load_credentials(credentials)
+        self.schema     = cred_dic['schema']
+        self.table      = cred_dic['table' ]
+        self.pool       = psycopg2.pool.ThreadedConnectionPool(MINCONN, MAXCONN,
+                                                               **nifti2database.utils.get_connection_parameters(cred_dic))
+        self.slots      = threading.BoundedSemaphore(MAXCONN)
+        self.last_used  = {}  # id(con) -> time.monotonic()
+
+    def getconn(self) -> psycopg2.extensions.connection:
+        if not self.slots.acquire(timeout=TIMEOUT):
+            raise psycopg2.pool.PoolError(f"database pool exhausted : no free connection after {TIMEOUT:g}s")
+        try:
+            for _ in range(MAXCONN + 1):  # all connections of the pool can be broken, after a database restart
+                con = self.pool.getconn()
+                idle_time = time.monotonic() - self.last_used.get(id(con), 0)
+                if idle_time < HEALTH_CHECK_INTERVAL or is_healthy(con):
+                    return con
+                niix2bids.utils.get_logger().warning("Discarding broken pooled connection")
+                self.last_used.pop(id(con), None)
+                self.pool.putconn(con, close=True)
+            raise psycopg2.OperationalError("no healthy connection in the pool")
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def putconn(self, con: psycopg2.extensions.connection) -> None:
+        # the pool rolls back an unfinished transaction, and drops a connection in an unknown state
+        self.last_used[id(con)] = time.monotonic()
+        self.pool.putconn(con)
+        self.slots.release()
+
+    def closeall(self) -> None:
+        self.pool.closeall()
+
+
+pools = {}  # realpath of the credentials file -> DatabasePool
+pools_lock = threading.Lock()
+
+
+########################################################################################################################
+def get_pool(credentials: str) -> DatabasePool:
+    key = os.path.realpath(credentials)
+    with pools_lock:
+        if key not in pools:
+            niix2bids.utils.get_logger().info(f"Creating connection pool for : {key} (max {MAXCONN} connections)")
+            pools[key] = DatabasePool(key)
+        return pools[key]
+
+
+########################################################################################################################
+@contextlib.contextmanager
+def connection(credentials: str):
+    # borrow a connection : yields the same (con, schema, table) as nifti2database.utils.connect_to_datase()
+    pool = get_pool(credentials)
+    con = pool.getconn()
+    try:
+        yield con, pool.schema, pool.table
+    finally:
+        pool.putconn(con)
+
+
+########################################################################################################################
+@atexit.register
+def close_all_pools() -> None:
+    with pools_lock:
+        for pool in pools.values():
+            pool.closeall()
+        pools.clear()
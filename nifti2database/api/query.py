@@ -0,0 +1,403 @@
+# standard modules
+import collections  # LRU of the results
+import json         # key of the cache, jsonb values, NDJSON
+import math         # NaN of the double precision columns
+import os           # environment variables & paths
+import threading    # the API serves requests in threads
+import time         # expiry of the results
+import typing       # just for function signature
+
+# dependency modules
+import niix2bids
+import psycopg2
+import psycopg2.pool
+
+# local modules
+import nifti2database
+import nifti2database.api.pool
+
+
+# results kept in the cache, and for how long : rows inserted by another process are seen after this delay
+CACHE_SIZE = int  (os.environ.get('NIFTI2DATABASE_QUERY_CACHE_SIZE', 256))
+CACHE_TTL  = float(os.environ.get('NIFTI2DATABASE_QUERY_CACHE_TTL' , 300))
+
+# rows per page, and rows per round trip of the server-side cursor of '"stream": true'
+MAX_PAGE_SIZE     = int(os.environ.get('NIFTI2DATABASE_QUERY_MAX_PAGE_SIZE', 1000))
+DEFAULT_PAGE_SIZE = 100
+STREAM_FETCH_SIZE = 2000
+
+# a query running longer than this is cancelled by the server (milliseconds)
+STATEMENT_TIMEOUT = int(os.environ.get('NIFTI2DATABASE_QUERY_STATEMENT_TIMEOUT', 60000))
+
+OPERATORS  = ('=', '!=', '<', '<=', '>', '>=', 'in', 'exists', 'type', 'like')
+AGGREGATES = ('count', 'min', 'max', 'avg', 'sum')
+JSON_TYPES = ('object', 'array', 'string', 'number', 'boolean', 'null')
+FIELDS     = ('credentials', 'where', 'group_by', 'aggregate', 'select', 'order_by', 'limit', 'offset', 'after',
+              'stream', 'cache')
+
+
+########################################################################################################################
+class ResultCache:
+    # LRU of the query results, each one valid for 'ttl' seconds
+    # emptied when rows are committed in the table by this process, see nifti2database.utils.add_commit_hook()
+
+    def __init__(self, size: int, ttl: float):
+        self.size       = size
+        self.ttl        = ttl
+        self.entries    = collections.OrderedDict()  # key -> (expiry, (schema, table), result)
+        self.lock       = threading.Lock()
+        self.generation = 0  # incremented by each invalidation : a result read before it is not stored
+        self.hits       = 0
+        self.misses     = 0
+
+    def get(self, key: str) -> dict | None:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key: str, table: tuple[str, str], result: dict, generation: int) -> None:
+        with self.lock:
+            if generation != self.generation or self.size <= 0:
+                return
+            self.entries[key] = (time.monotonic() + self.ttl, table, result)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, schema: str = None, table: str = None, nInserted: int = 0) -> None:
+        # schema=None : the table is unknown, drop everything
+        with self.lock:
+            self.generation += 1
+            if schema is None:
+                self.entries.clear()
+            else:
+                for key in [key for key, entry in self.entries.items() if entry[1] == (schema, table)]:
+                    del self.entries[key]
+
+
+result_cache = ResultCache(CACHE_SIZE, CACHE_TTL)
+nifti2database.utils.add_commit_hook(result_cache.invalidate)
+
+
+########################################################################################################################
+def check_key(key, where: str) -> str:
+    if type(key) is not str or len(key) == 0:
+        raise ValueError(f'{where} : key is not a string')
+    return key
+
+
+########################################################################################################################
+def get_list(req_dict: dict, field: str) -> list:
+    value = req_dict.get(field, [])
+    if type(value) is not list:
+        raise ValueError(f'"{field}" is not a list')
+    return value
+
+
+########################################################################################################################
+def parse_query(req_dict: dict) -> dict:
+    # check the JSON of the request, and return the query with the default values
+    # raise ValueError with the reason of the failure
+
+    if not req_dict or type(req_dict) is not dict:
+        raise ValueError('empty JSON')
+    unknown = [field for field in req_dict if field not in FIELDS]
+    if unknown:
+        raise ValueError(f'unknown fields {unknown}, valid fields are {list(FIELDS)}')
+
+    query = {
+        'credentials': req_dict.get('credentials',
+                                    os.path.join(os.path.expanduser('~'), 'credentials_nifti2database.json')),
+        'where'      : [],
+        'group_by'   : [check_key(key, '"group_by"') for key in get_list(req_dict, 'group_by')],
+        'aggregate'  : [],
+        'select'     : None,
+        'order_by'   : req_dict.get('order_by', 'count'),
+        'limit'      : req_dict.get('limit', DEFAULT_PAGE_SIZE),
+        'offset'     : req_dict.get('offset', 0),
+        'after'      : req_dict.get('after', ''),
+        'stream'     : bool(req_dict.get('stream', False)),
+        'cache'      : bool(req_dict.get('cache', True)),
+    }
+
+    # group_by or aggregate : 1 row per group, otherwise 1 row per scan
+    query['mode'] = 'aggregate' if ('group_by' in req_dict or 'aggregate' in req_dict) else 'rows'
+
+    if type(query['credentials']) is not str or not os.path.exists(query['credentials']):
+        raise ValueError('"credentials" file not found')
+
+    # [{"key": "PulseSequenceName", "op": "=", "value": "tfl"}, ...]
+    for condition in get_list(req_dict, 'where'):
+        if type(condition) is not dict:
+            raise ValueError('"where" is not a list of {"key": ..., "op": ..., "value": ...}')
+        key   = check_key(condition.get('key'), '"where"')
+        op    = condition.get('op', '=')
+        value = condition.get('value')
+        if op not in OPERATORS:
+            raise ValueError(f'"where" : unknown op "{op}", valid ops are {list(OPERATORS)}')
+        if op == 'in' and type(value) is not list:
+            raise ValueError('"where" : the value of "in" is not a list')
+        if op == 'exists' and type(value) is not bool:
+            value = True
+        if op == 'type' and value not in JSON_TYPES:
+            raise ValueError(f'"where" : the value of "type" is not in {list(JSON_TYPES)}')
+        if op == 'like' and type(value) is not str:
+            raise ValueError('"where" : the value of "like" is not a string')
+        if op in ('<', '<=', '>', '>=') and type(value) not in (int, float, str):
+            raise ValueError(f'"where" : the value of "{op}" is not a number or a string')
+        query['where'].append((key, op, value))
+
+    # [["avg", "RepetitionTime"], ...]
+    for aggregate in get_list(req_dict, 'aggregate'):
+        if type(aggregate) is not list or len(aggregate) != 2 or aggregate[0] not in AGGREGATES:
+            raise ValueError(f'"aggregate" is not a list of [function, key], valid functions are {list(AGGREGATES)}')
+        query['aggregate'].append((aggregate[0], check_key(aggregate[1], '"aggregate"')))
+
+    if 'select' in req_dict:
+        if query['mode'] == 'aggregate':
+            raise ValueError('"select" cannot be used with "group_by" or "aggregate"')
+        query['select'] = [check_key(key, '"select"') for key in get_list(req_dict, 'select')]
+
+    if query['order_by'] not in ('count', 'group'):
+        raise ValueError('"order_by" is not "count" or "group"')
+    if type(query['limit']) is not int or not 1 <= query['limit'] <= MAX_PAGE_SIZE:
+        raise ValueError(f'"limit" is not an integer between 1 and {MAX_PAGE_SIZE}, use "stream" for more rows')
+    if type(query['offset']) is not int or query['offset'] < 0:
+        raise ValueError('"offset" is not a positive integer')
+    if type(query['after']) is not str:
+        raise ValueError('"after" is not a string')
+
+    return query
+
+
+########################################################################################################################
+def get_key_expression(key: str, columns: dict) -> tuple[str, list, str]:
+    # (SQL, parameters, type) : the extracted column when the table has it, else the jsonb value
+    # the extracted column of a list (scan with several volumes) is its first element, see nifti2database.schema
+    if key in columns:
+        column, sql_type = columns[key]
+        return column, [], sql_type
+    return "dict->%s", [key], 'jsonb'
+
+
+########################################################################################################################
+def get_condition(key: str, op: str, value, columns: dict) -> tuple[str, list]:
+
+    # containment on the whole value uses the GIN index of dict, for any key
+    if op == '=':
+        return "dict @> %s::jsonb", [json.dumps({key: value})]
+    if op == '!=':
+        return "NOT dict @> %s::jsonb", [json.dumps({key: value})]
+    if op == 'in':
+        if len(value) == 0:
+            return "false", []
+        return "(" + " OR ".join(["dict @> %s::jsonb"] * len(value)) + ")", [json.dumps({key: item}) for item in value]
+
+    if op == 'exists':
+        return "dict ? %s" if value else "NOT dict ? %s", [key]
+    if op == 'type':
+        return "jsonb_typeof(dict->%s) = %s", [key, value]
+
+    expression, params, sql_type = get_key_expression(key, columns)
+    if op == 'like':
+        if sql_type == 'jsonb':
+            return "dict->>%s LIKE %s", [key, value]
+        return f"{expression}::text LIKE %s", params + [value]
+
+    # < <= > >= : numbers with numbers, strings with strings
+    if sql_type == 'jsonb':
+        return f"{expression} {op} %s::jsonb", params + [json.dumps(value)]
+    return f"{expression} {op} %s", params + [value]
+
+
+########################################################################################################################
+def get_aggregate_expression(function: str, key: str, columns: dict) -> tuple[str, list]:
+
+    expression, params, sql_type = get_key_expression(key, columns)
+    if function == 'count':  # scans that have this key
+        return f"count({expression})", params
+    if sql_type == 'double precision' or (sql_type == 'text' and function in ('min', 'max')):
+        return f"{function}({expression})", params
+
+    # the numbers of the key, the other values are ignored
+    return f"{function}(CASE WHEN jsonb_typeof(dict->%s) = 'number' THEN (dict->>%s)::double precision END)", [key, key]
+
+
+########################################################################################################################
+def build_sql(query: dict, schema: str, table: str, existing_columns: list[str], page: bool = True) -> tuple[str, list, list[str]]:
+    # (SQL, parameters, names of the columns of the result)
+    # the keys and values of the request are always sent as parameters, never pasted in the SQL
+
+    columns = {key: (column, sql_type) for column, key, sql_type in nifti2database.schema.EXTRACTED_COLUMNS
+               if column in existing_columns}
+
+    where_list   = []
+    where_params = []
+    for key, op, value in query['where']:
+        condition, params = get_condition(key, op, value, columns)
+        where_list  .append(condition)
+        where_params.extend(params)
+
+    select_list   = []
+    select_params = []
+    names         = []
+
+    if query['mode'] == 'aggregate':
+
+        for key in query['group_by']:
+            expression, params, _ = get_key_expression(key, columns)
+            select_list  .append(expression)
+            select_params.extend(params)
+            names        .append(key)
+        select_list.append("count(*)")
+        names      .append('count')
+        for function, key in query['aggregate']:
+            expression, params = get_aggregate_expression(function, key, columns)
+            select_list  .append(expression)
+            select_params.extend(params)
+            names        .append(f"{function}({key})")
+
+        sql = f"SELECT {', '.join(select_list)} FROM {schema}.{table}"
+        if where_list:
+            sql += " WHERE " + " AND ".join(where_list)
+
+        # by position, since the same key sent twice as a parameter is not the same expression for the server
+        positions = [str(idx+1) for idx in range(len(query['group_by']))]
+        count     = str(len(positions) + 1)
+        if positions:
+            sql += " GROUP BY " + ", ".join(positions)
+            order = [f"{count} DESC"] + positions if query['order_by'] == 'count' else positions + [f"{count} DESC"]
+            sql += " ORDER BY " + ", ".join(order)
+
+        page_params = []
+        if page:  # 1 more row, to know if there is a next page
+            sql += " LIMIT %s OFFSET %s"
+            page_params = [query['limit'] + 1, query['offset']]
+
+    else:
+
+        # keyset pagination on the primary key : each page is an index range scan, whatever its position
+        select_list.append("suid")
+        names      .append('suid')
+        if query['select'] is None:
+            select_list.append("dict")
+            names      .append('dict')
+        for key in query['select'] or []:
+            select_list  .append("dict->%s")
+            select_params.append(key)
+            names        .append(key)
+
+        where_list  .append("suid > %s")
+        where_params.append(query['after'])
+
+        sql = f"SELECT {', '.join(select_list)} FROM {schema}.{table} WHERE {' AND '.join(where_list)} ORDER BY suid"
+
+        page_params = []
+        if page:
+            sql += " LIMIT %s"
+            page_params = [query['limit'] + 1]
+
+    return sql + ";", select_params + where_params + page_params, names
+
+
+########################################################################################################################
+def get_row(names: list[str], row: tuple) -> dict:
+    # NaN/Infinity of the double precision columns are not valid JSON : null, as the other missing values
+    return {name: None if type(value) is float and not math.isfinite(value) else value for name, value in zip(names, row)}
+
+
+########################################################################################################################
+def begin_read_only(cur: psycopg2.extensions.cursor) -> None:
+    # the queries cannot write in the database, even with a bug in build_sql()
+    cur.execute("SET TRANSACTION READ ONLY;")
+    cur.execute("SET LOCAL statement_timeout = %s;", (STATEMENT_TIMEOUT,))
+
+
+########################################################################################################################
+def get_cache_key(query: dict) -> str:
+    key = {field: value for field, value in query.items() if field not in ('stream', 'cache')}
+    key['credentials'] = os.path.realpath(query['credentials'])
+    return json.dumps(key, sort_keys=True)
+
+
+########################################################################################################################
+def execute(query: dict) -> tuple[dict, bool]:
+    # returns (result, cached) : 1 page of the result, and the parameters of the next page, if any
+
+    log = niix2bids.utils.get_logger()
+
+    key = get_cache_key(query)
+    if query['cache']:
+        result = result_cache.get(key)
+        if result is not None:
+            return result, True
+    generation = result_cache.generation
+
+    start_time = time.time()
+    with nifti2database.api.pool.connection(query['credentials']) as (con, schema, table):
+        cur = con.cursor()
+        try:
+            begin_read_only(cur)
+            existing_columns = nifti2database.schema.get_existing_columns(cur, schema, table)
+            sql, params, names = build_sql(query, schema, table, existing_columns)
+            cur.execute(sql, params)
+            rows = cur.fetchall()
+        finally:
+            cur.close()
+            con.rollback()
+
+    next_page = None
+    if len(rows) > query['limit']:
+        rows = rows[:query['limit']]
+        if query['mode'] == 'aggregate':
+            next_page = {'offset': query['offset'] + query['limit']}
+        else:
+            next_page = {'after': rows[-1][0]}
+
+    result = {
+        'mode'   : query['mode'],
+        'columns': names,
+        'rows'   : [get_row(names, row) for row in rows],
+        'next'   : next_page,
+    }
+    log.info(f"query : {len(rows):,} rows in {time.time()-start_time:.3f}s")
+
+    if query['cache']:
+        result_cache.put(key, (schema, table), result, generation)
+
+    return result, False
+
+
+########################################################################################################################
+def stream(query: dict) -> typing.Iterator[str]:
+    # the whole result, 1 JSON line per row : the rows are read by batch through a server-side cursor,
+    # so neither the API nor the client hold the whole result in memory
+
+    log = niix2bids.utils.get_logger()
+
+    try:
+        with nifti2database.api.pool.connection(query['credentials']) as (con, schema, table):
+            try:
+                with con.cursor() as cur:
+                    begin_read_only(cur)
+                    existing_columns = nifti2database.schema.get_existing_columns(cur, schema, table)
+                sql, params, names = build_sql(query, schema, table, existing_columns, page=False)
+                with con.cursor(name='nifti2database_query') as cur:
+                    cur.itersize = STREAM_FETCH_SIZE
+                    cur.execute(sql, params)
+                    for row in cur:
+                        yield json.dumps(get_row(names, row), default=str) + '\n'
+            except psycopg2.Error as exc:  # the response is already started : the error is the last line
+                log.error(f"query failed : {exc}")
+                yield json.dumps({'success': False, 'reason': str(exc).strip()}) + '\n'
+            finally:
+                con.rollback()
+    except psycopg2.pool.PoolError as exc:  # no free connection in time : nothing was sent yet
+        log.error(f"query failed : {exc}")
+        yield json.dumps({'success': False, 'reason': str(exc)}) + '\n'
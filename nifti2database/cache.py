@@ -0,0 +1,82 @@
+# standard modules
+import logging
+import os
+import sqlite3
+
+# dependency modules
+import niix2bids
+from niix2bids.utils import logit
+
+# local modules
+
+
+CACHE_FILENAME = 'nifti2database_cache.sqlite'
+
+# paths per "IN (...)" query, below the limit of the number of parameters of old SQLite versions
+QUERY_BATCH_SIZE = 500
+
+
+########################################################################################################################
+def get_file_state(nii_path: str, json_path: str) -> tuple[int, int, int, int, int, int]:
+    # (mtime, size, inode) of the .nii and its .json : if one of them changes, the volume is parsed again
+    nii_stat  = os.stat(nii_path )
+    json_stat = os.stat(json_path)
+    return (nii_stat .st_mtime_ns, nii_stat .st_size, nii_stat .st_ino,
+            json_stat.st_mtime_ns, json_stat.st_size, json_stat.st_ino)
+
+
+########################################################################################################################
+@logit("Opening the file state cache", level=logging.INFO)
+def open_file_cache(out_dir: str) -> sqlite3.Connection:
+
+    log = niix2bids.utils.get_logger()
+
+    cache_file = os.path.join(out_dir, CACHE_FILENAME)
+    log.info(f"cache file : {cache_file}")
+
+    cache = sqlite3.connect(cache_file, timeout=60)  # several workers can share the same cache file
+    cache.execute("CREATE TABLE IF NOT EXISTS file_state ("
+                  "path TEXT PRIMARY KEY, "
+                  "nii_mtime INTEGER, nii_size INTEGER, nii_inode INTEGER, "
+                  "json_mtime INTEGER, json_size INTEGER, json_inode INTEGER);")
+    cache.commit()
+
+    return cache
+
+
+########################################################################################################################
+@logit("Skipping the files that did not change since the last run", level=logging.INFO)
+def filter_unchanged_files(cache: sqlite3.Connection,
+                           file_list_nii: list[str], file_list_json: list[str]) -> tuple[list[str], list[str], dict]:
+
+    log = niix2bids.utils.get_logger()
+
+    # only the files of this chunk : the cache holds the whole archive
+    known_state = {}
+    for idx in range(0, len(file_list_nii), QUERY_BATCH_SIZE):
+        batch = file_list_nii[idx:idx+QUERY_BATCH_SIZE]
+        rows = cache.execute(f"SELECT * FROM file_state WHERE path IN ({', '.join('?' * len(batch))});", batch)
+        known_state.update({row[0]: tuple(row[1:]) for row in rows})
+
+    changed_nii  = []
+    changed_json = []
+    new_state    = {}  # path -> state, to be written in the cache once the run is complete
+    for nii_path, json_path in zip(file_list_nii, file_list_json):
+        state = get_file_state(nii_path, json_path)
+        if known_state.get(nii_path) != state:
+            changed_nii .append(nii_path )
+            changed_json.append(json_path)
+            new_state[nii_path] = state
+
+    log.info(f"nFile={len(file_list_nii):,} // nUnchanged={len(file_list_nii)-len(changed_nii):,} // nChanged={len(changed_nii):,}")
+
+    return changed_nii, changed_json, new_state
+
+
+########################################################################################################################
+@logit("Writing the state of the processed files in the cache", level=logging.INFO)
+def update_file_cache(cache: sqlite3.Connection, file_state: dict) -> None:
+
+    cache.executemany("INSERT OR REPLACE INTO file_state VALUES (?, ?, ?, ?, ?, ?, ?);",
+                      [(path, *state) for path, state in file_state.items()])
+    cache.commit()
@@ -1,6 +1,7 @@
 # standard modules
 import argparse  # parser of the CLI
 import os        # for path management
+import sys       # to detect the 'watch' and 'schema' sub-commands
 
 # dependency modules
 import niix2bids
@@ -83,6 +84,92 @@ def get_parser() -> argparse.ArgumentParser:
                             const="prepare")
     exclusive1.set_defaults(connect_or_prepare="connect")
 
+    optional.add_argument("--batch_size",
+                          help=(
+                              "Number of scans sent to the database in a single multi-row 'INSERT' (default=%(default)s)\n"
+                              "With '--prepare', it is the number of rows per 'INSERT' line in the output file"
+                          ),
+                          dest="batch_size",
+                          metavar='N',
+                          type=int,
+                          default=1000)
+
+    optional.add_argument("--commit_mode",
+                          help=(
+                              "'batch' : commit after each batch of '--batch_size' scans (default)\n"
+                              "'run'   : commit once, at the end of the run"
+                          ),
+                          dest="commit_mode",
+                          choices=['batch', 'run'],
+                          default='batch')
+
+    optional.add_argument("--copy",
+                          help=(
+                              "Use PostgreSQL 'COPY' instead of 'INSERT', much faster for a first-time load of a whole archive.\n"
+                              "Scans are streamed in a staging table, then merged in the table in a single transaction.\n"
+                              "With '--prepare', write a .copy file (tab separated) that can be loaded with psql '\\copy'"
+                          ),
+                          dest="copy",
+                          action="store_true")
+
+    optional.add_argument("-j", "--jobs",
+                          help=(
+                              "Number of threads used to read the nifti headers concurrently (default=%(default)s)\n"
+                              "Useful on network storage (NFS), where reading headers is mostly waiting for I/O"
+                          ),
+                          dest="jobs",
+                          metavar='N',
+                          type=int,
+                          default=1)
+
+    optional.add_argument("--cache",
+                          help=(
+                              "Skip the files that did not change since the last run (same path, mtime, size and inode),\n"
+                              "before any parsing. Useful for nightly runs over a mostly unchanged archive.\n"
+                              "The state of the files is stored in <out_dir>/nifti2database_cache.sqlite,\n"
+                              "so '--out_dir' has to be defined too.\n"
+                              "With '--prepare', the cache is only read, not updated : the scans are not in the database yet"
+                          ),
+                          dest="cache",
+                          action="store_true")
+
+    optional.add_argument("--chunk_size",
+                          help=(
+                              "Process the '--in_dir' directories by chunks of N directories (default=0, all at once).\n"
+                              "Each chunk goes through the whole pipeline, up to the database insertion, before the next one.\n"
+                              "Peak memory is then bounded by the chunk size, not the archive size.\n"
+                              "Use it with one directory per session, such as /path/to/nii/2021_*"
+                          ),
+                          dest="chunk_size",
+                          metavar='N',
+                          type=int,
+                          default=0)
+
+    optional.add_argument("--workers",
+                          help=(
+                              "Number of processes used to ingest the '--in_dir' directories in parallel (default=%(default)s).\n"
+                              "Each worker runs the whole pipeline on its chunks, with its own database connection.\n"
+                              "Sessions are independent, so use it with one directory per session, such as /path/to/nii/2021_*"
+                          ),
+                          dest="workers",
+                          metavar='N',
+                          type=int,
+                          default=1)
+
+    optional.add_argument("--profile",
+                          help=(
+                              "Profile the run with cProfile (time) and tracemalloc (memory) (default=off).\n"
+                              "'--profile' profiles all the chunks, '--profile N' profiles 1 chunk out of N,\n"
+                              "so it can stay enabled on large runs, with a low overhead.\n"
+                              "The .prof file and the report are written next to the log file, or in the log without '--out_dir'"
+                          ),
+                          dest="profile",
+                          metavar='N',
+                          type=int,
+                          nargs='?',
+                          const=1,
+                          default=0)
+
     optional.add_argument("--config_file",
                           help=(
                               "If you want to use non-coded sequences such as new Products, WIP or C2P,\n"
@@ -137,6 +224,16 @@ def get_parser() -> argparse.ArgumentParser:
 ########################################################################################################################
 def main() -> None:
 
+    # daemon mode : nifti2database watch ...
+    if len(sys.argv) > 1 and sys.argv[1] == 'watch':
+        nifti2database.watch.main(sys.argv[2:])
+        return
+
+    # migration of the table : nifti2database schema ...
+    if len(sys.argv) > 1 and sys.argv[1] == 'schema':
+        nifti2database.schema.main(sys.argv[2:])
+        return
+
     # Parse inputs
     parser = get_parser()       # Fetch my parser
     args = parser.parse_args()  # Parse
@@ -0,0 +1,53 @@
+# standard modules
+import os         # for path management
+import threading  # the API loads configs from several threads
+
+# dependency modules
+import niix2bids
+
+# local modules
+import nifti2database
+
+
+configs      = {}  # realpath of the config file -> ((mtime, size), config)
+configs_lock = threading.Lock()
+
+
+########################################################################################################################
+def resolve_config_file(config_file: str | list[str]) -> str | None:
+    # the default of the CLI is a list of candidates : the first existing one is used, like niix2bids does
+    candidates = config_file if isinstance(config_file, list) else [config_file]
+    for candidate in candidates:
+        if os.path.exists(candidate):
+            return os.path.realpath(candidate)
+    return None
+
+
+########################################################################################################################
+def load_config_file(config_file: str | list[str]) -> list:
+    # same as niix2bids.utils.load_config_file(), but in a long-lived process (API) the config module is only
+    # executed again when the file changes
+    # !! the returned config is shared between runs : do not modify it !!
+
+    log = niix2bids.utils.get_logger()
+
+    path = resolve_config_file(config_file)
+    if path is None:
+        return niix2bids.utils.load_config_file(config_file)  # let niix2bids report the missing file
+
+    file_stat = os.stat(path)
+    state     = (file_stat.st_mtime_ns, file_stat.st_size)
+
+    with configs_lock:
+        cached_state, cached_config = configs.get(path, (None, None))
+    if cached_state == state:
+        log.info(f"Using cached config file : {path}")
+        return cached_config
+
+    config = niix2bids.utils.load_config_file(path)
+    nifti2database.utils.compile_config(config)  # the compiled regex are cached too
+
+    with configs_lock:
+        configs[path] = (state, config)
+
+    return config
@@ -0,0 +1,221 @@
+# standard modules
+import contextlib  # stage() context manager
+import json        # metrics file
+import os          # current RSS
+import threading   # the API runs several workflows at the same time
+import time        # wall & cpu time
+
+try:  # not available on Windows
+    import resource
+except ImportError:
+    resource = None
+
+# dependency modules
+import niix2bids
+
+# local modules
+
+
+# counters of the chunk statistics (see nifti2database.workflow.new_chunk_stats) summed in the metrics
+COUNTERS = ('files', 'volumes', 'volumes_unchanged', 'volumes_in_database',
+            'scans', 'scans_inserted', 'scans_skipped', 'bytes_sent')
+
+
+########################################################################################################################
+def get_peak_rss_mb() -> float:
+    # high-water mark of the resident memory of this process, since its start or the last reset_peak_rss()
+    if resource is None:
+        return 0.0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # kB on Linux
+
+
+########################################################################################################################
+def get_current_rss_mb() -> float:
+    try:
+        with open('/proc/self/statm') as fp:
+            return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024**2
+    except (OSError, ValueError, IndexError):  # not Linux
+        return 0.0
+
+
+########################################################################################################################
+def reset_peak_rss() -> bool:
+    # Linux : writing '5' in clear_refs resets the high-water mark of the process (VmHWM, and ru_maxrss with it)
+    try:
+        with open('/proc/self/clear_refs', mode='wt') as fp:
+            fp.write('5')
+        return True
+    except OSError:  # not Linux, or /proc is read-only
+        return False
+
+
+# the high-water mark is reset at the start of each stage, so each stage gets its own peak
+# before a reset, the peak so far is kept in the stages being measured (other threads of the API) and in 'hwm_mb'
+rss_state = {'hwm_mb': 0.0, 'resettable': True, 'open_stages': {}}  # open_stages : token -> peak of the stage so far
+rss_lock  = threading.Lock()
+
+
+########################################################################################################################
+def collect_peak_rss() -> None:
+    # to call with 'rss_lock'
+    peak = get_peak_rss_mb()
+    rss_state['hwm_mb'] = max(rss_state['hwm_mb'], peak)
+    if rss_state['resettable']:  # otherwise, it is the peak of the whole process : useless for a stage
+        for token, stage_peak in rss_state['open_stages'].items():
+            rss_state['open_stages'][token] = max(stage_peak, peak)
+
+
+########################################################################################################################
+def get_rss_hwm_mb() -> float:
+    # high-water mark of the resident memory of this process, since its start, despite the resets
+    with rss_lock:
+        collect_peak_rss()
+        return rss_state['hwm_mb']
+
+
+########################################################################################################################
+class Metrics:
+    # per-stage wall time, cpu time, peak and delta of RSS, and item counts, of 1 run of the workflow
+    # cpu time and RSS are the ones of the process : with concurrent runs (API), they include the other runs
+    # without /proc/self/clear_refs (not Linux), the peak RSS of a stage is the max of its start and end
+
+    def __init__(self):
+        self.start_wall = time.perf_counter()
+        self.start_cpu  = time.process_time()
+        self.start_time = time.time()
+        self.stages     = {}  # name -> {'calls', 'wall', 'cpu', 'rss_peak_mb', 'rss_delta_mb'}, in order of first call
+        self.counters   = dict.fromkeys(COUNTERS, 0) | {'chunks': 0, 'errors': 0}
+        self.hooks      = []  # called with the name of the stage, at its end
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        start_wall = time.perf_counter()
+        start_cpu  = time.process_time()
+        start_rss  = get_current_rss_mb()
+        token      = object()
+        with rss_lock:
+            collect_peak_rss()
+            rss_state['open_stages'][token] = start_rss
+            rss_state['resettable'] = rss_state['resettable'] and reset_peak_rss()
+        try:
+            yield
+        finally:
+            end_rss = get_current_rss_mb()
+            with rss_lock:
+                collect_peak_rss()
+                peak_rss = max(rss_state['open_stages'].pop(token), end_rss)
+            self.add_stage(name, {
+                'calls'       : 1,
+                'wall'        : time.perf_counter() - start_wall,
+                'cpu'         : time.process_time() - start_cpu,
+                'rss_peak_mb' : peak_rss,
+                'rss_delta_mb': end_rss - start_rss,
+            })
+            for hook in self.hooks:
+                hook(name)
+
+    def add_stage(self, name: str, stage: dict) -> None:
+        if name not in self.stages:
+            self.stages[name] = stage.copy()
+            return
+        current = self.stages[name]
+        current['calls'       ] += stage['calls']
+        current['wall'        ] += stage['wall']
+        current['cpu'         ] += stage['cpu']
+        current['rss_delta_mb'] += stage['rss_delta_mb']
+        current['rss_peak_mb' ]  = max(current['rss_peak_mb'], stage['rss_peak_mb'])
+
+    def add_chunk(self, stats: dict) -> None:
+        for key in COUNTERS:
+            self.counters[key] += stats.get(key, 0)
+        self.counters['chunks'] += 1
+        self.counters['errors'] += stats.get('error') is not None
+
+    def merge(self, other: dict) -> None:
+        # stages measured in a worker process, see to_dict()
+        for name, stage in other['stages'].items():
+            self.add_stage(name, stage)
+
+    def to_dict(self) -> dict:
+        return {
+            'start_time'    : self.start_time,
+            'wall'          : time.perf_counter() - self.start_wall,
+            'cpu'           : time.process_time() - self.start_cpu,
+            'rss_peak_mb'   : max([get_current_rss_mb()] + [stage['rss_peak_mb'] for stage in self.stages.values()]),
+            'rss_current_mb': get_current_rss_mb(),
+            'rss_hwm_mb'    : get_rss_hwm_mb(),  # of the process, since its start : in the API, includes the previous runs
+            'stages'        : {name: stage.copy() for name, stage in self.stages.items()},
+            'counters'      : self.counters.copy(),
+        }
+
+
+########################################################################################################################
+def log_metrics(metrics_dict: dict) -> None:
+
+    log = niix2bids.utils.get_logger()
+
+    for name, stage in metrics_dict['stages'].items():
+        log.info(f"stage {name:<29} : calls={stage['calls']:<4} wall={stage['wall']:8.3f}s "
+                 f"cpu={stage['cpu']:8.3f}s rss_peak={stage['rss_peak_mb']:,.0f}MB rss_delta={stage['rss_delta_mb']:+,.0f}MB")
+    log.info(' // '.join(f"{key}={value:,}" for key, value in metrics_dict['counters'].items()))
+
+
+########################################################################################################################
+def write_metrics_file(metrics_file: str, metrics_dict: dict) -> None:
+
+    log = niix2bids.utils.get_logger()
+
+    log.info(f"metrics file : {metrics_file}")
+    with open(metrics_file, mode='wt', encoding='utf-8') as fp:
+        json.dump(metrics_dict, fp, indent=4)
+
+
+# totals of all the runs of this process, exposed by the API at /metrics
+totals = {'runs': 0, 'stages': {}, 'counters': {}}
+totals_lock = threading.Lock()
+
+
+########################################################################################################################
+def add_to_totals(metrics_dict: dict) -> None:
+    with totals_lock:
+        totals['runs'] += 1
+        for name, stage in metrics_dict['stages'].items():
+            total = totals['stages'].setdefault(name, {'calls': 0, 'wall': 0.0, 'cpu': 0.0})
+            for key in total:
+                total[key] += stage[key]
+        for key, value in metrics_dict['counters'].items():
+            totals['counters'][key] = totals['counters'].get(key, 0) + value
+
+
+########################################################################################################################
+def render_prometheus() -> str:
+    # text exposition format of Prometheus : https://prometheus.io/docs/instrumenting/exposition_formats/
+
+    with totals_lock:
+        lines = [
+            "# HELP nifti2database_runs_total Number of workflow runs",
+            "# TYPE nifti2database_runs_total counter",
+            f"nifti2database_runs_total {totals['runs']}",
+        ]
+
+        for metric, key, help_str in (('stage_calls_total'       , 'calls', "Number of calls of each stage"),
+                                      ('stage_wall_seconds_total', 'wall' , "Wall time spent in each stage"),
+                                      ('stage_cpu_seconds_total' , 'cpu'  , "CPU time of the process during each stage")):
+            lines.append(f"# HELP nifti2database_{metric} {help_str}")
+            lines.append(f"# TYPE nifti2database_{metric} counter")
+            for name, stage in totals['stages'].items():
+                lines.append(f'nifti2database_{metric}{{stage="{name}"}} {stage[key]}')
+
+        lines.append("# HELP nifti2database_items_total Number of items processed, such as files, volumes or scans")
+        lines.append("# TYPE nifti2database_items_total counter")
+        for key, value in totals['counters'].items():
+            lines.append(f'nifti2database_items_total{{item="{key}"}} {value}')
+
+    lines.append("# HELP nifti2database_rss_hwm_bytes High-water mark of the resident memory of the process, since its start")
+    lines.append("# TYPE nifti2database_rss_hwm_bytes gauge")
+    lines.append(f"nifti2database_rss_hwm_bytes {get_rss_hwm_mb() * 1024**2:.0f}")
+    lines.append("# HELP nifti2database_rss_bytes Resident memory of the process")
+    lines.append("# TYPE nifti2database_rss_bytes gauge")
+    lines.append(f"nifti2database_rss_bytes {get_current_rss_mb() * 1024**2:.0f}")
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,171 @@
+# standard modules
+import contextlib  # chunk() context manager
+import cProfile    # where the time goes
+import io          # text report of pstats
+import pstats      # merge the profiles of the chunks
+import threading   # tracemalloc is shared by the concurrent runs of the API
+import tracemalloc # where the memory goes
+
+# dependency modules
+import niix2bids
+
+# local modules
+
+
+# number of lines in the text report
+TOP_FUNCTIONS   = 40
+TOP_ALLOCATIONS = 30
+
+
+# tracemalloc is global to the process : it runs as long as 1 profiled chunk needs it
+tracing_users = 0
+tracing_lock = threading.Lock()
+
+
+########################################################################################################################
+def start_tracing() -> None:
+    global tracing_users
+    with tracing_lock:
+        if tracing_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        tracing_users += 1
+
+
+########################################################################################################################
+def stop_tracing() -> None:
+    global tracing_users
+    with tracing_lock:
+        tracing_users -= 1
+        if tracing_users == 0:
+            tracemalloc.stop()
+
+
+########################################################################################################################
+class RawStats:
+    # pstats.Stats.add() accepts any object with create_stats() and a .stats dict :
+    # used for the profiles sent back by the worker processes, since cProfile.Profile cannot be pickled
+
+    def __init__(self, stats: dict):
+        self.stats = stats
+
+    def create_stats(self) -> None:
+        pass
+
+
+########################################################################################################################
+class Profiler:
+    # cProfile & tracemalloc on 1 chunk out of 'sample' : with a large sample, the overhead on a large run stays low
+    # sample=0 : no profiling
+    # cProfile only sees the thread of the run, but tracemalloc sees the whole process :
+    # with concurrent runs (API), the allocations of the other runs are counted too
+
+    def __init__(self, sample: int = 1):
+        self.sample    = sample
+        self.nChunk    = 0
+        self.nProfiled = 0
+        self.stats     = None  # pstats.Stats of all profiled chunks
+        self.peak      = None  # top allocations at the largest traced memory, see stage_end()
+        self.label     = None  # chunk being profiled
+        self.profile   = None  # cProfile.Profile of this chunk
+
+    @contextlib.contextmanager
+    def chunk(self, label: str, index: int = None):
+        # index : position of the chunk in the run, to sample the same chunks whatever the process running them
+
+        log = niix2bids.utils.get_logger()
+
+        index = self.nChunk if index is None else index
+        self.nChunk += 1
+        if self.sample == 0 or index % self.sample != 0:
+            yield
+            return
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:  # another profiler is active in this process
+            log.warning(f"profiler already active, chunk not profiled : {label}")
+            yield
+            return
+
+        start_tracing()
+        self.label, self.profile = label, profile
+
+        try:
+            yield
+        finally:
+            profile.disable()
+            self.label, self.profile = None, None
+            stop_tracing()
+            profile.create_stats()
+            self.add_stats(profile.stats)
+            self.nProfiled += 1
+
+    def stage_end(self, name: str) -> None:
+        # called at the end of each stage (see nifti2database.metrics.Metrics.stage) :
+        # keep the allocations of the stage end with the most traced memory, that is the peak of the run, roughly
+        if self.label is None or not tracemalloc.is_tracing():
+            return
+        traced, _ = tracemalloc.get_traced_memory()
+        if self.peak is not None and traced <= self.peak['traced']:
+            return
+        self.profile.disable()  # the snapshot is not part of the profile
+        snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+        self.peak = {
+            'traced': traced,
+            'where' : f"end of {name}, chunk {self.label}",
+            'top'   : [(stat.size, stat.count, str(stat.traceback)) for stat in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]],
+        }
+        self.profile.enable()
+
+    def add_stats(self, raw_stats: dict) -> None:
+        if self.stats is None:
+            self.stats = pstats.Stats(RawStats(raw_stats))
+        else:
+            self.stats.add(RawStats(raw_stats))
+
+    def to_dict(self) -> dict:
+        # picklable, for the worker processes
+        return {
+            'nChunk'   : self.nChunk,
+            'nProfiled': self.nProfiled,
+            'stats'    : None if self.stats is None else self.stats.stats,
+            'peak'     : self.peak,
+        }
+
+    def merge(self, other: dict) -> None:
+        self.nChunk    += other['nChunk']
+        self.nProfiled += other['nProfiled']
+        if other['stats'] is not None:
+            self.add_stats(other['stats'])
+        if other['peak'] is not None and (self.peak is None or other['peak']['traced'] > self.peak['traced']):
+            self.peak = other['peak']
+
+    def format_report(self) -> str:
+
+        stream = io.StringIO()
+        stream.write(f"Profiled chunks : {self.nProfiled:,}/{self.nChunk:,} (1 out of {self.sample})\n\n")
+
+        if self.stats is not None:
+            self.stats.stream = stream
+            self.stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(TOP_FUNCTIONS)
+
+        if self.peak is not None:
+            stream.write(f"Top allocations, {self.peak['traced']/1024**2:,.1f}MB traced at the {self.peak['where']}\n")
+            for size, count, where in self.peak['top']:
+                stream.write(f"{size/1024:12,.1f}kB {count:10,} blocks  {where}\n")
+
+        return stream.getvalue()
+
+    def write(self, prefix: str) -> None:
+        # <prefix>.prof can be opened with pstats, snakeviz...
+
+        log = niix2bids.utils.get_logger()
+
+        if self.stats is not None:
+            self.stats.dump_stats(prefix + '.prof')
+            log.info(f"profile file : {prefix}.prof")
+
+        with open(prefix + '.txt', mode='wt', encoding='utf-8') as fp:
+            fp.write(self.format_report())
+        log.info(f"profile report : {prefix}.txt")
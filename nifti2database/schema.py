@@ -0,0 +1,221 @@
+# standard modules
+import argparse  # parser of the schema command
+import logging   # for the logit decorator
+import os        # for path management
+import zlib      # short signature of the extracted columns
+
+# dependency modules
+import niix2bids
+from niix2bids.utils import logit
+import psycopg2
+
+# local modules
+import nifti2database
+
+
+# hottest keys of the queries : copied from 'dict' in their own column, with a B-tree index
+# (column, key in dict, SQL type)
+EXTRACTED_COLUMNS = [
+    ('pulse_sequence_name'  , 'PulseSequenceName'  , 'text'            ),
+    ('suffix'               , 'suffix'             , 'text'            ),
+    ('tag'                  , 'tag'                , 'text'            ),
+    ('protocol_name'        , 'ProtocolName'       , 'text'            ),
+    ('acquisition_date_time', 'AcquisitionDateTime', 'text'            ),  # ISO 8601 : text order is time order
+    ('patient_name'         , 'PatientName'        , 'text'            ),
+    ('rx'                   , 'Rx'                 , 'double precision'),
+    ('ry'                   , 'Ry'                 , 'double precision'),
+    ('rz'                   , 'Rz'                 , 'double precision'),
+]
+
+
+########################################################################################################################
+def get_extract_expression(key: str, sql_type: str, source: str = 'dict') -> str:
+
+    # a scan with several volumes can have a list instead of a scalar : use its first element
+    value = f"CASE jsonb_typeof({source}->'{key}') WHEN 'array' THEN {source}->'{key}'->>0 ELSE {source}->>'{key}' END"
+    if sql_type == 'text':
+        return value
+
+    # numbers, or "NaN" written by the serializer : anything else gives NULL, instead of an error that blocks the insert
+    return f"CASE WHEN ({value}) ~ '^(-?[0-9.]+([eE][-+]?[0-9]+)?|NaN|-?Infinity)$' THEN ({value})::{sql_type} END"
+
+
+########################################################################################################################
+def get_existing_columns(cur: psycopg2.extensions.cursor, schema: str, table: str) -> list[str]:
+    # the extracted columns already added to the table by the migration, in the order of EXTRACTED_COLUMNS
+    cur.execute("SELECT column_name FROM information_schema.columns WHERE table_schema = %s AND table_name = %s;",
+                (schema, table))
+    existing = {row[0] for row in cur.fetchall()}
+    return [column for column, _, _ in EXTRACTED_COLUMNS if column in existing]
+
+
+########################################################################################################################
+def get_statement_signature(schema: str, table: str, columns: list[str]) -> str:
+    # part of the name of the prepared statement : a migration during the life of a connection gives a new statement
+    # short, since PostgreSQL truncates the names longer than 63 characters
+    key = f"{schema}.{table}:" + ','.join(columns)
+    return f"{zlib.crc32(key.encode()):08x}"
+
+
+########################################################################################################################
+def get_insert_lists(columns: list[str], source: str = 'dict') -> tuple[str, str]:
+    # (column list, select list) of the "INSERT ... SELECT" of the scans, with the extracted columns of the table
+    extract = {column: (key, sql_type) for column, key, sql_type in EXTRACTED_COLUMNS}
+    column_list = ', '.join(['dict', 'suid', 'patient_id', 'insertion_time'] + columns)
+    select_list = ', '.join([source, 'suid', 'patient_id', 'now()'] +
+                            [get_extract_expression(*extract[column], source) for column in columns])
+    return column_list, select_list
+
+
+########################################################################################################################
+def get_index_statements(schema: str, table: str, concurrently: bool = False) -> list[str]:
+
+    cc = 'CONCURRENTLY ' if concurrently else ''
+
+    # GIN index for the containment queries on any key : dict @> '{"PulseSequenceName": "tfl"}'
+    statements = [f"CREATE INDEX {cc}IF NOT EXISTS {table}_dict_path_ops_idx ON {schema}.{table} USING gin (dict jsonb_path_ops);"]
+
+    # B-tree index for equality, range and ORDER BY on the extracted columns
+    for column, _, _ in EXTRACTED_COLUMNS:
+        statements.append(f"CREATE INDEX {cc}IF NOT EXISTS {table}_{column}_idx ON {schema}.{table} ({column});")
+
+    return statements
+
+
+########################################################################################################################
+def get_add_column_statements(schema: str, table: str) -> list[str]:
+    # without default value, adding a column does not rewrite the table
+    return [f"ALTER TABLE {schema}.{table} ADD COLUMN IF NOT EXISTS {column} {sql_type};"
+            for column, _, sql_type in EXTRACTED_COLUMNS]
+
+
+########################################################################################################################
+def get_backfill_statement(schema: str, table: str, key_range: bool = True) -> str:
+    # fill the extracted columns of the rows inserted before the migration, or by a '--prepare' file
+    # only the rows that are not up to date are written, so it can be run again at any time
+
+    set_list   = ', '.join(f"{column} = {get_extract_expression(key, sql_type)}" for column, key, sql_type in EXTRACTED_COLUMNS)
+    to_update  = ' OR '.join(f"{column} IS DISTINCT FROM {get_extract_expression(key, sql_type)}"
+                             for column, key, sql_type in EXTRACTED_COLUMNS)
+    statement  = f"UPDATE {schema}.{table} SET {set_list} WHERE ({to_update})"
+    if key_range:  # batch of rows, using the primary key
+        statement += " AND suid > %s AND (%s IS NULL OR suid <= %s)"
+    return statement + ";"
+
+
+########################################################################################################################
+@logit("Filling the extracted columns of the rows already in database", level=logging.INFO)
+def backfill(con: psycopg2.extensions.connection, schema: str, table: str, batch_size: int = 10000) -> int:
+    # 1 transaction per batch of rows : the table stays available, and an interrupted backfill can be resumed
+
+    log = niix2bids.utils.get_logger()
+
+    cur = con.cursor()
+    statement = get_backfill_statement(schema, table)
+
+    nUpdated = 0
+    lower = ''
+    while True:
+        cur.execute(f"SELECT suid FROM {schema}.{table} WHERE suid > %s ORDER BY suid LIMIT 1 OFFSET %s;",
+                    (lower, batch_size - 1))
+        row = cur.fetchone()
+        upper = row[0] if row else None
+        cur.execute(statement, (lower, upper, upper))
+        nUpdated += cur.rowcount
+        con.commit()
+        if upper is None:
+            break
+        lower = upper
+    cur.close()
+
+    log.info(f"nRowUpdated={nUpdated:,}")
+    return nUpdated
+
+
+########################################################################################################################
+@logit("Migration of the table : extracted columns and indexes", level=logging.INFO)
+def migrate(con: psycopg2.extensions.connection, schema: str, table: str,
+            batch_size: int = 10000, concurrently: bool = False) -> None:
+
+    log = niix2bids.utils.get_logger()
+
+    cur = con.cursor()
+    for statement in get_add_column_statements(schema, table):
+        log.info(statement)
+        cur.execute(statement)
+    con.commit()
+
+    # before the indexes, so they are built once, on the filled columns
+    backfill(con, schema, table, batch_size)
+
+    # CONCURRENTLY : the table stays writable while the index is built, but it cannot run in a transaction
+    con.autocommit = concurrently
+    for statement in get_index_statements(schema, table, concurrently):
+        log.info(statement)
+        cur.execute(statement)
+    con.commit()
+    con.autocommit = False
+
+    cur.execute(f"ANALYZE {schema}.{table};")
+    con.commit()
+    cur.close()
+
+
+########################################################################################################################
+def get_parser() -> argparse.ArgumentParser:
+
+    parser = argparse.ArgumentParser(
+        prog='nifti2database schema',
+        description="""
+    Migrate the table : GIN index on 'dict', and columns extracted from 'dict' with their B-tree index.
+    The scans inserted from now on fill these columns. The rows already in the table are filled by the migration.
+    It can be run again at any time, such as after loading a '--prepare' file.
+    """,
+        formatter_class=argparse.RawTextHelpFormatter)
+
+    parser.add_argument("--credentials",
+                        help="Same as the CLI (default=%(default)s)",
+                        metavar='FILE',
+                        default=os.path.join(os.path.expanduser('~'), 'credentials_nifti2database.json'))
+    parser.add_argument("--batch_size",
+                        help="Number of rows filled per transaction (default=%(default)s)",
+                        metavar='N',
+                        type=int,
+                        default=10000)
+    parser.add_argument("--concurrently",
+                        help="Build the indexes with CREATE INDEX CONCURRENTLY : slower, but the table stays writable",
+                        action='store_true')
+    parser.add_argument("--print",
+                        help="Do not connect : print the SQL of the migration, such as for a DBA",
+                        dest='print_sql',
+                        action='store_true')
+    parser.add_argument("--schema",
+                        help="With '--print', schema of the table (default=%(default)s)",
+                        default='nifti2database_schema')
+    parser.add_argument("--table",
+                        help="With '--print', name of the table (default=%(default)s)",
+                        default='nifti_json')
+
+    return parser
+
+
+########################################################################################################################
+def main(argv: list[str] = None) -> None:
+
+    args = get_parser().parse_args(argv)
+
+    if args.print_sql:
+        statements = get_add_column_statements(args.schema, args.table) + \
+                     [get_backfill_statement(args.schema, args.table, key_range=False)] + \
+                     get_index_statements(args.schema, args.table, args.concurrently) + \
+                     [f"ANALYZE {args.schema}.{args.table};"]
+        print('\n'.join(statements))
+        return
+
+    niix2bids.utils.init_logger(write_file=False, out_dir='')
+
+    con, schema, table = nifti2database.utils.connect_to_datase('connect', args.credentials)
+    try:
+        migrate(con, schema, table, args.batch_size, args.concurrently)
+    finally:
+        con.close()
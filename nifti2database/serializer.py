@@ -0,0 +1,188 @@
+# standard modules
+import json
+
+# dependency modules
+import niix2bids
+import numpy as np
+
+try:  # optional : faster encoder, the output text is more compact but the jsonb in the database is the same
+    import orjson
+except ImportError:
+    orjson = None
+
+# local modules
+
+
+# fields rounded to 3 digits : this step looks overkill, but the simplification makes the jsonb (in the database) much cleaner
+# => request in the database will be simplified, since the rounding will be done
+ROUNDED_KEYS = frozenset(['Mx', 'My', 'Mz', 'Mt',
+                          'Rx', 'Ry', 'Rz', 'Rt',
+                          'Fx', 'Fy', 'Fz', 'Ft',
+                          'Matrix', 'Resolution', 'FoV'])
+
+
+########################################################################################################################
+def int_or_round3__scalar(scalar):
+    if scalar != scalar:  # NaN
+        return scalar
+    scalar = float(scalar)  # conversion to the builtin float to avoid numpy.float64
+    scalar_round0 = round(scalar)
+    scalar_round3 = round(scalar,3)
+    return scalar_round0 if scalar_round0 == scalar_round3 else scalar_round3
+
+
+########################################################################################################################
+def int_or_round3(input):
+    # apply 'int_or_round3__scalar' on each element or sub-element
+    if type(input) == np.float64 or type(input) == np.float32:  # this is a scalar
+        return int_or_round3__scalar(input)
+    else:  # tuple ? list[tuple] ?
+        output_list = []
+        for elem in input:
+            if type(elem) is tuple:  # tuple
+                output_list.append( tuple(map(int_or_round3__scalar,elem)) )
+            else:
+                output_list.append( int_or_round3__scalar(elem) )
+        return output_list
+
+
+########################################################################################################################
+def encode_float(value: float):
+    if value - value == 0:  # finite
+        return float(value)  # numpy.float64/float32 to the builtin float
+    # NaN is not valid JSON : store it as the string "NaN"
+    if value != value:
+        return "NaN"
+    return "Infinity" if value > 0 else "-Infinity"
+
+
+########################################################################################################################
+def encode_sequence(value: list | tuple) -> list:
+    return [encode(elem) for elem in value]
+
+
+########################################################################################################################
+def encode_dict(value: dict) -> dict:
+    return {str(key): encode(elem) for key, elem in value.items()}
+
+
+########################################################################################################################
+def encode_identity(value):
+    return value
+
+
+# type dispatch : one lookup per value, instead of a chain of isinstance()
+ENCODERS = {
+    str       : encode_identity,
+    int       : encode_identity,
+    bool      : encode_identity,
+    type(None): encode_identity,
+    float     : encode_float,
+    list      : encode_sequence,
+    tuple     : encode_sequence,
+    dict      : encode_dict,
+    np.float64: encode_float,
+    np.float32: encode_float,
+    np.int64  : int,
+    np.int32  : int,
+    np.int16  : int,
+    np.uint16 : int,
+    np.bool_  : bool,
+    np.str_   : str,
+}
+
+
+########################################################################################################################
+def encode(value):
+    # convert any value into builtin JSON types, recursively : numpy scalars become builtin scalars,
+    # and NaN/Infinity become strings
+    encoder = ENCODERS.get(type(value))
+    if encoder is None:
+        if isinstance(value, np.generic):  # other numpy scalars
+            return encode(value.item())
+        raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+    return encoder(value)
+
+
+########################################################################################################################
+def encode_default(value):
+    # called by the encoders only for the types they do not know
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+# same output as json.dumps(), the encoder is built once, and the scans have no circular reference
+JSON_ENCODER = json.JSONEncoder(default=encode_default, check_circular=False)
+
+
+########################################################################################################################
+def dumps(value) -> str:
+
+    # fast path : the C encoder (or orjson) does the recursion
+    # NaN/Infinity nested in lists are rare, they are detected in the output, and only then the value is fully encoded
+    if orjson is not None:
+        dict_bytes = orjson.dumps(value, default=encode_default, option=orjson.OPT_SERIALIZE_NUMPY)
+        if b'null' not in dict_bytes:  # orjson writes NaN as null
+            return dict_bytes.decode('utf-8')
+        return orjson.dumps(encode(value)).decode('utf-8')
+
+    dict_str = JSON_ENCODER.encode(value)
+    if 'NaN' not in dict_str and 'Infinity' not in dict_str:
+        return dict_str
+    return JSON_ENCODER.encode(encode(value))
+
+
+########################################################################################################################
+def clean_scan(scan: dict) -> dict:
+    # single pass on the fields of the scan, nested values are left to the encoder
+
+    scan_clean = {}
+    for key, value in scan.items():
+        value_type = type(value)
+        if value_type is np.float64:  # np.float64 come from DataFrame columns, where NaN management turned int into float
+            scan_clean[key] = int(value) if value.is_integer() else encode_float(value)
+        elif value_type is np.bool_:
+            scan_clean[key] = bool(value)
+        else:
+            scan_clean[key] = value
+
+    # the few fields with a specific treatment are overwritten in place, so the order of the keys is kept
+
+    # change Volume objects to a standard path str
+    if type(scan['Volume']) is niix2bids.classes.Volume:
+        scan_clean['Volume'] = scan['Volume'].nii.path
+    else:  # its a list[Volume]
+        scan_clean['Volume'] = [vol.nii.path for vol in scan['Volume']]
+
+    for key in ROUNDED_KEYS.intersection(scan):
+        scan_clean[key] = int_or_round3(scan[key])
+
+    if 'run' in scan:
+        scan_clean['run'] = int(scan['run'])
+    else:
+        scan_clean['run'] = encode_float(np.nan)
+
+    return scan_clean
+
+
+########################################################################################################################
+def get_patient_id(scan: dict) -> str:
+    # 'AcquisitionDateTime': '2021-10-25T09:36:22.535000' => split with the T, replace - by _
+    acquisition_datetime = scan.get('AcquisitionDateTime')
+    if type(acquisition_datetime) is list:
+        acquisition_datetime = acquisition_datetime[0]
+    if type(acquisition_datetime) is str:
+        return acquisition_datetime.split('T')[0].replace('-','_') + "_" + scan['PatientName']
+    return scan['PatientName']
+
+
+########################################################################################################################
+def serialize_scan(scan: dict) -> tuple[str, str, str]:
+    # return the columns of the table : (dict, suid, patient_id)
+
+    scan_clean = clean_scan(scan)
+
+    first_SeriesInstanceUID = scan_clean['SeriesInstanceUID'] if type(scan_clean['SeriesInstanceUID']) is str else scan_clean['SeriesInstanceUID'][0]
+
+    return dumps(scan_clean), first_SeriesInstanceUID, get_patient_id(scan_clean)
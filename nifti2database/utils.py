@@ -5,6 +5,14 @@ import os
 import json
 import random
 import string
+import datetime
+import re
+import concurrent.futures
+import functools
+import gzip
+import io
+import threading
+import typing
 
 # dependency modules
 import niix2bids
@@ -16,6 +24,22 @@ import pandas
 import psycopg2
 
 # local modules
+import nifti2database.serializer
+import nifti2database.schema
+
+
+# niix2bids registers each new Volume in the class attribute Volume.instances
+# => the creation is serialized, and each run keeps its own list, so concurrent runs do not share their volumes
+volume_lock = threading.Lock()
+
+
+########################################################################################################################
+def create_volume_list(file_list_nii: list[str]) -> list[Volume]:
+    with volume_lock:
+        niix2bids.classes.Volume.instances = []
+        volume_list = niix2bids.utils.create_volume_list(file_list_nii)
+        niix2bids.classes.Volume.instances = []  # the list now belongs to the run only
+    return volume_list
 
 
 ########################################################################################################################
@@ -57,46 +81,104 @@ def display_logs_from_decision_tree(volume_list: list[Volume]) -> None:
         log.info(msg)
 
 
+########################################################################################################################
+# only the fields needed for Matrix/Resolution/FoV, the rest of the 348 bytes is skipped
+NIFTI1_HEADER_SIZE  = 348
+NIFTI1_HEADER_DTYPE = np.dtype([
+    ('sizeof_hdr', 'i4'      ),  # offset 0
+    ('skip1'     , 'V36'     ),
+    ('dim'       , 'i2', (8,)),  # offset 40
+    ('skip2'     , 'V20'     ),
+    ('pixdim'    , 'f4', (8,)),  # offset 76
+    ('skip3'     , 'V236'    ),
+    ('magic'     , 'S4'      ),  # offset 344
+])
+
+
+########################################################################################################################
+def read_nifti_header_raw(path: str) -> tuple[tuple, tuple] | None:
+    # read only the first 348 bytes, and decode dim & pixdim
+    # for .nii.gz, only the first gzip block is decompressed
+    # return None if the file is not a "standard" NIfTI-1, so the caller can fallback to nibabel
+
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as fp:
+        raw = fp.read(NIFTI1_HEADER_SIZE)
+    if len(raw) < NIFTI1_HEADER_SIZE:
+        return None
+
+    hdr = np.frombuffer(raw, dtype=NIFTI1_HEADER_DTYPE.newbyteorder('<'), count=1)[0]
+    if hdr['sizeof_hdr'] != NIFTI1_HEADER_SIZE:  # maybe big endian
+        hdr = np.frombuffer(raw, dtype=NIFTI1_HEADER_DTYPE.newbyteorder('>'), count=1)[0]
+        if hdr['sizeof_hdr'] != NIFTI1_HEADER_SIZE:  # NIfTI-2 or not a nifti
+            return None
+    if hdr['magic'] not in (b'n+1', b'ni1'):
+        return None
+
+    dim    = hdr['dim'   ]
+    pixdim = hdr['pixdim'].astype(np.float32)  # native byte order
+    ndim   = dim[0]
+    if not 1 <= ndim <= 7 or np.any(dim[1:ndim+1] < 1) or np.any(pixdim[1:4] <= 0):
+        return None  # nibabel has special rules for these cases
+
+    matrix     = tuple(int(mx) for mx in dim[1:ndim+1])
+    resolution = tuple(pixdim[1:ndim+1])
+    return matrix, resolution
+
+
+########################################################################################################################
+def read_nifti_header(path: str) -> tuple[tuple, tuple]:
+
+    header = read_nifti_header_raw(path)
+    if header is not None:
+        return header
+
+    # fallback for unusual files
+    nii = nibabel.load(path)
+    return nii.header.get_data_shape(), nii.header.get_zooms()
+
+
 ########################################################################################################################
 @logit("Reading all nifti headers to extract info absent from the JSON. This may take a while... ", level=logging.INFO)
-def read_all_nifti_header(df: pandas.DataFrame) -> pandas.DataFrame:
-
-    Matrix     = []
-    Resolution = []
-    FoV        = []
-
-    for row in df.index:
-
-        # shortcut
-        vol = df.loc[row,'Volume']
-
-        # load header
-        nii = nibabel.load(vol.nii.path)
-
-        # fetch raw parameters
-        matrix = nii.header.get_data_shape()
-        resolution = nii.header.get_zooms()
-        fov = tuple([ mx*res for mx,res in zip(matrix, resolution)])
-
-        df.loc[row,'Mx'] = matrix[0]
-        df.loc[row,'My'] = matrix[1]
-        df.loc[row,'Mz'] = matrix[2]
-        if len(matrix) == 4:
-            df.loc[row,'Mt'] = matrix[3]
-        df.loc[row,'Rx'] = resolution[0]
-        df.loc[row,'Ry'] = resolution[1]
-        df.loc[row,'Rz'] = resolution[2]
-        if len(resolution) == 4:
-            df.loc[row,'Rt'] = resolution[3]
-        df.loc[row,'Fx'] = fov[0]
-        df.loc[row,'Fy'] = fov[1]
-        df.loc[row,'Fz'] = fov[2]
-        if len(fov) == 4:
-            df.loc[row,'Ft'] = fov[3]
-
-        Matrix.append(matrix)
-        Resolution.append(resolution)
-        FoV.append(fov)
+def read_all_nifti_header(df: pandas.DataFrame, jobs: int = 1) -> pandas.DataFrame:
+
+    path_list = [vol.nii.path for vol in df['Volume']]
+
+    # reading headers is mostly waiting for I/O, so threads are enough to overlap them
+    # executor.map() keeps the input order, so the result is identical to the serial path
+    if jobs > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            header_list = list(executor.map(read_nifti_header, path_list))
+    else:
+        header_list = list(map(read_nifti_header, path_list))
+
+    return add_nifti_header_to_dataframe(df, header_list)
+
+
+########################################################################################################################
+def add_nifti_header_to_dataframe(df: pandas.DataFrame, header_list: list[tuple[tuple, tuple]]) -> pandas.DataFrame:
+
+    Matrix     = [matrix     for matrix, _     in header_list]
+    Resolution = [resolution for _, resolution in header_list]
+    FoV        = [tuple([ mx*res for mx,res in zip(matrix, resolution)]) for matrix, resolution in header_list]
+
+    # build all scalar columns at once, as float64 arrays, like the NaN-filled columns of the former cell-by-cell writes
+    columns = {}
+    if len(df) > 0:
+        is_4d = [len(matrix) == 4 for matrix in Matrix]
+        for prefix, values in (('M', Matrix), ('R', Resolution), ('F', FoV)):
+            for idx, axis in enumerate('xyz'):
+                columns[f'{prefix}{axis}'] = np.array([value[idx] for value in values], dtype=np.float64)
+            if any(is_4d):
+                columns[f'{prefix}t'] = np.array([value[3] if value_is_4d else np.nan
+                                                  for value, value_is_4d in zip(values, is_4d)], dtype=np.float64)
+
+        # column order is the order of first appearance : Mt/Rt/Ft are interleaved only if the first volume is 4D
+        if not is_4d[0]:
+            order = [f'{prefix}{axis}' for prefix in 'MRF' for axis in 'xyz'] + [f'{prefix}t' for prefix in 'MRF' if f'{prefix}t' in columns]
+            columns = {name: columns[name] for name in order}
+
+    df = pandas.concat([df, pandas.DataFrame(columns, index=df.index)], axis=1)
 
     df['Matrix'    ] = Matrix
     df['Resolution'] = Resolution
@@ -108,18 +190,32 @@ def read_all_nifti_header(df: pandas.DataFrame) -> pandas.DataFrame:
 ########################################################################################################################
 @logit("Concatenate BIDSfields from niix2bids to the json dict", level=logging.INFO)
 def concat_bidsfields_to_seqparam(df: pandas.DataFrame) -> pandas.DataFrame:
-    
-    for row in df.index:
-
-        # shortcut
-        vol = df.loc[row,'Volume']
-
-        for key in vol.bidsfields:
-            df.loc[row,key] = vol.bidsfields[key]
-        df.loc[row,'tag'   ] = vol.tag
-        df.loc[row,'suffix'] = vol.suffix
-        df.loc[row,'sub'   ] = vol.sub
-        
+
+    # collect plain records first, then build all new columns in one DataFrame
+    records = []
+    for vol in df['Volume']:
+        record = dict(vol.bidsfields)
+        record['tag'   ] = vol.tag
+        record['suffix'] = vol.suffix
+        record['sub'   ] = vol.sub
+        records.append(record)
+
+    new = pandas.DataFrame.from_records(records, index=df.index)
+
+    # mimic the dtype of the columns created with df.loc[row,key] = value : no int64 nor bool column
+    for key in new.columns:
+        if pandas.api.types.is_integer_dtype(new[key]):
+            new[key] = new[key].astype(np.float64)
+        elif pandas.api.types.is_bool_dtype(new[key]):
+            new[key] = new[key].astype(object)
+
+    # existing columns are only overwritten on the rows where the key is present
+    for key in new.columns.intersection(df.columns):
+        present = np.array([key in record for record in records], dtype=bool)
+        df.loc[present, key] = new.loc[present, key]
+
+    df = pandas.concat([df, new[new.columns.difference(df.columns, sort=False)]], axis=1)
+
     return df
 
 
@@ -129,12 +225,15 @@ def build_scan_from_series(df: pandas.DataFrame, config: list) -> list[dict]:
 
     scans = []  # list[dict]
 
-    # call each routine depending on the sequence name
-    for seq_regex, fcn_name in config:  # loop over sequence decision tree
+    # unique() is not possible on 'list' or 'dict' : convert them once, for all the rows
+    df_hashable = get_hashable_dataframe(df)
+
+    # each volume goes to the first sequence of the config that matches its PulseSequenceName
+    config_index = get_config_index(df, config)
 
-        # get list of corresponding sequence
-        seqinfo = niix2bids.decision_tree.utils.slice_with_genericfield(df, 'PulseSequenceName', seq_regex)
-        if seqinfo.empty: continue  # just to run the code faster
+    # partition the volumes by sequence, in a single pass
+    for idx, seqinfo in df.groupby(config_index, sort=True):
+        if idx < 0: continue  # sequence not in the config
 
         # we group using raw json info and the "run" number from the bids decision tree in niix2bids
         columns = ['PatientName', 'ProtocolName', 'run', 'MRAcquisitionType', 'StudyInstanceUID']
@@ -142,41 +241,112 @@ def build_scan_from_series(df: pandas.DataFrame, config: list) -> list[dict]:
             columns.append('PhaseEncodingDirection')
         # 'MRAcquisitionType' is can help sometimes for grouping
 
-        groups = seqinfo.groupby(by=columns, dropna=False)
-        for _, series in groups:
+        scans.extend(collapse_groups(seqinfo, df_hashable.loc[seqinfo.index], columns))
+
+    return scans
+
+
+########################################################################################################################
+def compile_config(config: list) -> tuple[re.Pattern]:
+    return compile_regex_list(tuple(seq_regex for seq_regex, fcn_name in config))
+
+
+########################################################################################################################
+@functools.lru_cache(maxsize=16)
+def compile_regex_list(regex_list: tuple[str]) -> tuple[re.Pattern]:
+    # a long-lived process (API) compiles the regex of a config only once
+    return tuple(re.compile(seq_regex) for seq_regex in regex_list)
+
+
+########################################################################################################################
+def get_config_index(df: pandas.DataFrame, config: list) -> pandas.Series:
+    # match each unique PulseSequenceName once against the compiled regex of the config
+    # the result is the index of the first matching entry in the config, -1 if none
+
+    if 'PulseSequenceName' not in df.columns:
+        return pandas.Series(-1, index=df.index)
+
+    regex_list = compile_config(config)
 
-            scan = series.to_dict('list')  # convert the DataFrame to standard dict
+    index_map = {}
+    for name in df['PulseSequenceName'].unique():
+        index_map[name] = -1
+        if type(name) is not str:
+            continue
+        for idx, regex in enumerate(regex_list):
+            if regex.match(name):
+                index_map[name] = idx
+                break
 
-            to_delete = []
+    return df['PulseSequenceName'].map(index_map).fillna(-1).astype(int)
 
-            for key in scan.keys():
 
-                try:
-                    unique_stuff = series[key].unique()
-                    if len(unique_stuff) == 1:
-                        scan[key] = unique_stuff[0]
+########################################################################################################################
+def to_hashable(value):
+    if isinstance(value, list):
+        return tuple(to_hashable(elem) for elem in value)
+    if isinstance(value, dict):
+        return tuple(sorted((key, to_hashable(elem)) for key, elem in value.items()))
+    return value
+
+
+########################################################################################################################
+def get_hashable_dataframe(df: pandas.DataFrame) -> pandas.DataFrame:
+    # only 'object' columns can contain list or dict
+    columns = {}
+    for key in df.columns:
+        if df[key].dtype == object:
+            columns[key] = df[key].map(to_hashable)
+        else:
+            columns[key] = df[key]
+    return pandas.DataFrame(columns, index=df.index)
+
+
+########################################################################################################################
+def collapse_groups(seqinfo: pandas.DataFrame, seqinfo_hashable: pandas.DataFrame, columns: list[str]) -> list[dict]:
+
+    scans = []
+
+    # for all groups and all columns at once : is the column constant in the group ?
+    # NaN is counted as a value, like unique() does
+    group_id = seqinfo.groupby(by=columns, dropna=False).ngroup().to_numpy()
+    nunique  = seqinfo_hashable.groupby(group_id).nunique(dropna=False)
+    constant = nunique.to_numpy() == 1
+    keys     = list(seqinfo.columns)
+
+    # row positions of each group, in the group order
+    order    = np.argsort(group_id, kind='stable')
+    boundary = np.searchsorted(group_id[order], np.arange(len(nunique)+1))
 
-                except TypeError:  # unique() on 'list' is not possible, but it is on 'tuple'
+    # same values as DataFrame.to_dict('list'), but computed once for all groups
+    lists  = {key: seqinfo[key].tolist()    for key in keys}
+    # the value of a constant column is taken from the first row of the group, with the same type as unique()[0]
+    values = {key: seqinfo[key].to_numpy() for key in keys}
 
-                    try:
-                        unique_stuff = series[key].transform(tuple).unique()
-                        if len(unique_stuff) == 1:
-                            scan[key] = unique_stuff[0]
-                    except ValueError:  # rare bug :  "ValueError: Function did not transform"
-                        pass  # in this case, just do nothing, no simplification
+    for gid in range(len(nunique)):
 
-                # remove nan
-                if (type(scan[key]) is np.float64 or type(scan[key]) is float) and np.isnan(scan[key]):
-                    to_delete.append(key)
+        position = order[boundary[gid]:boundary[gid+1]]
+        scan = {key: [lists[key][pos] for pos in position] for key in keys}  # convert the group to standard dict
 
-                # convert some fields into regular builtin objects
-                if type(scan[key]) is np.int64:
-                    scan[key] = int(scan[key])
+        first = position[0]
+        for key in [key for key, is_constant in zip(keys, constant[gid]) if is_constant]:
 
-            for key in to_delete:  # remove keys with just a 1x1 nan
+            value = values[key][first]
+            if type(value) is list:
+                value = tuple(value)
+
+            # remove nan
+            if (type(value) is np.float64 or type(value) is float) and np.isnan(value):
                 del scan[key]
-    
-            scans.append(scan)
+                continue
+
+            # convert some fields into regular builtin objects
+            if type(value) is np.int64:
+                value = int(value)
+
+            scan[key] = value
+
+        scans.append(scan)
 
     return scans
 
@@ -202,6 +372,31 @@ def remove_duplicate(scans: list[dict]) -> list[dict]:
     return scans_unique
 
 
+########################################################################################################################
+def load_credentials(credentials: str) -> dict:
+    with open(credentials,'r') as fid:
+        cred_dic = json.load(fid)
+    return cred_dic
+
+
+########################################################################################################################
+def get_connection_parameters(cred_dic: dict) -> dict:
+
+    connection_parameters = {
+        "database": cred_dic['database'],
+        "user"    : cred_dic['user'    ],
+        "password": cred_dic['password'],
+        "host"    : cred_dic['host'    ],
+        "port"    : cred_dic['port'    ],
+    }
+    if "sslmode" in cred_dic.keys():
+        connection_parameters['sslmode'   ] = cred_dic['sslmode'   ]
+    if "gssencmode" in cred_dic.keys():
+        connection_parameters['gssencmode'] = cred_dic['gssencmode']
+
+    return connection_parameters
+
+
 ########################################################################################################################
 @logit("Connection to database using psycopg2.connect()", level=logging.INFO)
 def connect_to_datase(connect_or_prepare: str, credentials:  str) -> psycopg2.extensions.connection:
@@ -212,24 +407,13 @@ def connect_to_datase(connect_or_prepare: str, credentials:  str) -> psycopg2.ex
 
         # fetch credentials in home directory
         log.info(f"Loading credentials : {credentials}")
-        with open(credentials,'r') as fid:
-            cred_dic = json.load(fid)
+        cred_dic = load_credentials(credentials)
 
         # connect to DB
         log.info(f"Connecting to database...")
 
         # prepare connection parameters
-        connection_parameters = {
-            "database": cred_dic['database'],
-            "user"    : cred_dic['user'    ],
-            "password": cred_dic['password'],
-            "host"    : cred_dic['host'    ],
-            "port"    : cred_dic['port'    ],
-        }
-        if "sslmode" in cred_dic.keys():
-            connection_parameters['sslmode'   ] = cred_dic['sslmode'   ]
-        if "gssencmode" in cred_dic.keys():
-            connection_parameters['gssencmode'] = cred_dic['gssencmode']
+        connection_parameters = get_connection_parameters(cred_dic)
 
         # connect
         con = psycopg2.connect(**connection_parameters)
@@ -242,9 +426,74 @@ def connect_to_datase(connect_or_prepare: str, credentials:  str) -> psycopg2.ex
         return None, None, None
 
 
+########################################################################################################################
+@logit("Fetching SeriesInstanceUID of the scans already in database", level=logging.INFO)
+def fetch_existing_series(con: psycopg2.extensions.connection, schema: str, table: str,
+                          suid_list: list[str], batch_size: int = 1000) -> frozenset[str]:
+
+    log = niix2bids.utils.get_logger()
+
+    # only send the candidates, by batch : the primary key index answers, and the cost scales with the new data,
+    # not with the size of the table
+    # 'suid' is only the first SeriesInstanceUID of the scan : a scan made of several series (mp2rage, magnitude+phase, ...)
+    # stores all of them in dict->'SeriesInstanceUID', so fetch them too
+    suid_list = sorted(set(suid_list))
+    db_id = set()
+    cur = con.cursor()
+    for batch in split_in_batch(suid_list, batch_size):
+        cur.execute(f"SELECT suid, dict->'SeriesInstanceUID' FROM {schema}.{table} WHERE suid = ANY(%s);", (batch,))
+        for suid, series in cur:
+            db_id.add(suid)
+            if type(series) is list:
+                db_id.update(series)
+    cur.close()
+    db_id = frozenset(db_id)  # fronzenset is supposed to be faster for comparaison operations
+
+    log.info(f"nCandidate={len(suid_list):,} // nFoundInDB={len(db_id):,}")
+
+    return db_id
+
+
+########################################################################################################################
+@logit("Removing volumes whose series is already in database", level=logging.INFO)
+def remove_existing_volumes(volume_list: list[Volume], db_id: frozenset[str]) -> list[Volume]:
+
+    log = niix2bids.utils.get_logger()
+
+    volume_new = [vol for vol in volume_list if vol.seqparam.get('SeriesInstanceUID') not in db_id]
+
+    log.info(f"nVolume={len(volume_list):,} // nVolumeInDB={len(volume_list)-len(volume_new):,} // nVolumeNew={len(volume_new):,}")
+
+    return volume_new
+
+
+# functions called once insert_scan_to_database() committed new rows : hook(schema, table, nInserted)
+# schema and table are None when unknown, such as for the rows inserted by the worker processes
+# used by the result cache of the API, see nifti2database.api.query
+commit_hooks = []
+
+
+########################################################################################################################
+def add_commit_hook(hook: typing.Callable[[str, str, int], None]) -> None:
+    if hook not in commit_hooks:
+        commit_hooks.append(hook)
+
+
+########################################################################################################################
+def run_commit_hooks(schema: str, table: str, nInserted: int) -> None:
+    for hook in list(commit_hooks):
+        try:
+            hook(schema, table, nInserted)
+        except Exception:  # the rows are committed anyway : a broken hook must not fail the run
+            niix2bids.utils.get_logger().exception(f"Error in commit hook : {hook}")
+
+
 ########################################################################################################################
 @logit("Get list of scans in database, and add the 'new' ones", level=logging.INFO)
-def insert_scan_to_database(con: psycopg2.extensions.connection, schema: str, table: str, scans: list[dict]) -> list[str]:
+def insert_scan_to_database(con: psycopg2.extensions.connection, schema: str, table: str, scans: list[dict],
+                            batch_size: int = 1000, commit_mode: str = 'batch', copy: bool = False,
+                            db_id: frozenset[str] = None, stats: dict = None) -> list[tuple[str, str, str]]:
+    # stats : if given, receives 'scans_inserted', 'scans_skipped' and 'bytes_sent'
 
     log = niix2bids.utils.get_logger()
 
@@ -255,21 +504,16 @@ def insert_scan_to_database(con: psycopg2.extensions.connection, schema: str, ta
 
         # first, we check if the scan already exist --------------------------------------------------------------------
 
-        log.info("Fetching existing scans in database")
-
-        # get list of scans in the db
-        cur.execute(f"SELECT suid FROM {schema}.{table};")
-        db_id = cur.fetchall()
-        db_id = frozenset([id[0] for id in db_id])  # fronzenset is supposed to be faster for comparaison operations
+        # establish scan_id
+        scan_id = [ scan['SeriesInstanceUID'] if type(scan['SeriesInstanceUID']) is str else scan['SeriesInstanceUID'][0]
+                    for scan in scans ]
 
-        log.info(f"Found {len(db_id):,} scans in database")
+        # the workflow usually fetched them before the decision tree
+        if db_id is None:
+            db_id = fetch_existing_series(con, schema, table, scan_id, batch_size)
 
         if len(db_id)>0:  # just to check if the db is empty or not
 
-            # establish scan_id
-            scan_id = [ scan['SeriesInstanceUID'] if type(scan['SeriesInstanceUID']) is str else scan['SeriesInstanceUID'][0]
-                        for scan in scans ]
-
             # remove if already exist
             to_remove = [ sid in db_id for sid in scan_id ]  # list[bool]
             scan_new = []
@@ -286,141 +530,262 @@ def insert_scan_to_database(con: psycopg2.extensions.connection, schema: str, ta
     log.info(f"nScanDB={len(scans):,} // nScanToAdd={len(scans):,} // nScanNew={len(scan_new):,}")
 
     # insert new scans -------------------------------------------------------------------------------------------------
-    insert_list = []
+    insert_rows = []
     for scan in scan_new:
 
         # change some variables type so they can fit in the SQL request
-        scan_clean = scan.copy()
-
-        # change Volume objects to a standard path str
-        if type(scan['Volume']) is niix2bids.classes.Volume:
-            scan_clean['Volume'] = scan['Volume'].nii.path
-        else: # its a list[Volume]
-            path_list = []
-            for vol in scan['Volume']:
-                path_list.append(vol.nii.path)
-            scan_clean['Volume'] = path_list
-
-        # clean values =================================================================================================
-        # this step looks overkill, but the simplification makes the jsonb (in the database) much cleaner
-        # => request in the database will be simplified, since the rounding will be done
-
-        # this function will convert scalar
-        def int_or_round3__scalar(scalar):
-            if (type(scalar) is np.float64 or type(scalar) is float) and np.isnan(scalar):
-                return scalar
-            scalar = float(scalar)  # conversion to the builtin float to avoid numpy.float64
-            scalar = round(scalar) if round(scalar) == round(scalar,3) else round(scalar,3)
-            return scalar
-
-        # this function will 'apply int_or_round3__scalar' on each element or sub-element
-        def int_or_round3(input):
-            if type(input) == np.float64 or type(input) == np.float32:  # this is a scalar
-                return int_or_round3__scalar(input)
-            else:  # tuple ? list[tuple] ?
-                output_list = []
-                for elem in input:
-                    if type(elem) is tuple:  # tuple
-                        output_list.append( tuple(map(int_or_round3__scalar,elem)) )
-                    else:
-                        output_list.append( int_or_round3__scalar(elem) )
-                return output_list
-
-        scan_clean['Mx'] = int_or_round3(scan_clean['Mx'])
-        scan_clean['My'] = int_or_round3(scan_clean['My'])
-        scan_clean['Mz'] = int_or_round3(scan_clean['Mz'])
-        if 'Mt' in scan_clean.keys():
-            scan_clean['Mt'] = int_or_round3(scan_clean['Mt'])
-
-        scan_clean['Rx'] = int_or_round3(scan_clean['Rx'])
-        scan_clean['Ry'] = int_or_round3(scan_clean['Ry'])
-        scan_clean['Rz'] = int_or_round3(scan_clean['Rz'])
-        if 'Rt' in scan_clean.keys():
-            scan_clean['Rt'] = int_or_round3(scan_clean['Rt'])
-
-        scan_clean['Fx'] = int_or_round3(scan_clean['Fx'])
-        scan_clean['Fy'] = int_or_round3(scan_clean['Fy'])
-        scan_clean['Fz'] = int_or_round3(scan_clean['Fz'])
-        if 'Ft' in scan_clean.keys():
-            scan_clean['Ft'] = int_or_round3(scan_clean['Ft'])
-
-        scan_clean['Matrix'    ] = int_or_round3(scan_clean['Matrix'    ])
-        scan_clean['Resolution'] = int_or_round3(scan_clean['Resolution'])
-        scan_clean['FoV'       ] = int_or_round3(scan_clean['FoV'       ])
-
-        if 'run' not in scan_clean.keys():
-            scan_clean['run'] = np.nan
-        else:
-            scan_clean['run'] = int(scan_clean['run'])
+        row = nifti2database.serializer.serialize_scan(scan)
+
+        log.info(f"Adding scan to database : { scan['Volume'].nii.path if type(scan['Volume']) is Volume else [vol.nii.path for vol in scan['Volume']] } ")
+
+        insert_rows.append(row)
+
+    nInserted = len(insert_rows)  # '--prepare' : all rows are written in the file
 
-        # try to convert back to int the np.flot64 : this is due to NaN management in DataFrame
-        for key in scan_clean.keys():
-            if type(scan_clean[key]) is np.float64 and scan_clean[key] == int(scan_clean[key]):
-                scan_clean[key] = int(scan_clean[key])
+    if con is not None and copy:
 
-        # convert numpy.bool_ to builtin bool
-        for key in scan_clean.keys():
-            if type(scan_clean[key]) is np.bool_:
-                scan_clean[key] = bool(scan_clean[key])
+        # stream all rows in a single COPY, then merge them in the table
+        nInserted = copy_rows_to_database(cur, schema, table, insert_rows)
+        con.commit()
 
-        # ==========================================================================================================
+    elif con is not None:
 
-        dict_str = json.dumps(scan_clean)
+        # send the rows by batch, through a statement planned once by the server : 1 round trip per batch
+        nInserted = 0
+        statement = prepare_insert_statement(cur, schema, table)
+        for batch in split_in_batch(insert_rows, batch_size):
+            dict_list, suid_list, patient_id_list = map(list, zip(*batch))
+            cur.execute(f"EXECUTE {statement} (%s::jsonb[], %s::varchar[], %s::varchar[]);",
+                        (dict_list, suid_list, patient_id_list))
+            nInserted += cur.rowcount  # ON CONFLICT rows are not counted
+            if commit_mode == 'batch':
+                con.commit()
+        if commit_mode == 'run':
+            con.commit()
 
-        # change NaN to 'NaN'
-        dict_str = dict_str.replace('NaN', '"NaN"')
+    if con is not None:
 
-        first_SeriesInstanceUID = scan_clean['SeriesInstanceUID'] if type(scan_clean['SeriesInstanceUID']) is str else scan_clean['SeriesInstanceUID'][0]
+        log.info(f"Inserted {nInserted:,} scans in database")
 
-        # 'AcquisitionDateTime': '2021-10-25T09:36:22.535000' => split with the T, replace - by _
-        if type(scan_clean['AcquisitionDateTime']) is str:
-            patient_id = scan_clean['AcquisitionDateTime']   .split('T')[0].replace('-','_') + "_" + scan_clean['PatientName']
-        elif type(scan_clean['AcquisitionDateTime']) is list:
-            patient_id = scan_clean['AcquisitionDateTime'][0].split('T')[0].replace('-','_') + "_" + scan_clean['PatientName']
+        cur.close()
 
-        log.info(f"Adding scan to database : { scan_clean['Volume'] } ")
+        if nInserted > 0:
+            run_commit_hooks(schema, table, nInserted)
 
-        insert_line = f"INSERT INTO {schema}.{table} (dict, suid, patient_id, insertion_time) VALUES('{dict_str}', '{first_SeriesInstanceUID}', '{patient_id}', now());"
-        insert_list.append(insert_line)
+    if stats is not None:
+        stats['scans_inserted'] = nInserted
+        stats['scans_skipped' ] = len(scans) - nInserted
+        stats['bytes_sent'    ] = sum(len(dict_str.encode('utf-8')) for dict_str, _, _ in insert_rows)
 
-        if con is not None:
+    return insert_rows
 
-            # insert request
-            cur.execute(insert_line)
-            con.commit()
 
-    if con is not None:
-        cur.close()
-        con.close()
+########################################################################################################################
+def prepare_insert_statement(cur: psycopg2.extensions.cursor, schema: str, table: str) -> str:
+    # server-side prepared statement : parsed and planned once per connection, then EXECUTE'd for each batch
+    # the values are bound as arrays, so the JSON text is never pasted in the SQL
+    # the extracted columns of the table (see nifti2database.schema) are computed from 'dict' by the server
+
+    columns = nifti2database.schema.get_existing_columns(cur, schema, table)
+    column_list, select_list = nifti2database.schema.get_insert_lists(columns)
+    statement = f"nifti2database_insert__{nifti2database.schema.get_statement_signature(schema, table, columns)}"
+
+    cur.execute("SELECT 1 FROM pg_prepared_statements WHERE name = %s;", (statement,))
+    if cur.fetchone() is None:
+        cur.execute(f"PREPARE {statement} (jsonb[], varchar[], varchar[]) AS "
+                    f"INSERT INTO {schema}.{table} ({column_list}) "
+                    f"SELECT {select_list} FROM unnest($1, $2, $3) AS new_row(dict, suid, patient_id) "
+                    f"ON CONFLICT (suid) DO NOTHING;")
 
-    log.info("Connection to database closed")
+    return statement
+
+
+########################################################################################################################
+def split_in_batch(items: list, batch_size: int) -> list[list]:
+    batch_size = max(batch_size, 1)
+    return [items[idx:idx+batch_size] for idx in range(0, len(items), batch_size)]
+
+
+########################################################################################################################
+def quote_literal(value: str) -> str:
+    # SQL string literal, for the file output only : the database path binds the values
+    return "'" + value.replace("'", "''") + "'"
+
+
+########################################################################################################################
+def render_insert_list(schema: str, table: str, insert_rows: list[tuple[str, str, str]], batch_size: int = 1000) -> list[str]:
+
+    insert_list = []
+    for batch in split_in_batch(insert_rows, batch_size):
+        values = ",\n".join([f"({quote_literal(dict_str)}, {quote_literal(suid)}, {quote_literal(patient_id)}, now())"
+                            for dict_str, suid, patient_id in batch])
+        insert_list.append(f"INSERT INTO {schema}.{table} (dict, suid, patient_id, insertion_time) VALUES\n{values};")
 
     return insert_list
 
 
 ########################################################################################################################
-@logit(f"Writing INSERT lines to file",level=logging.INFO)
-def write_insert_list(logfile: str, insert_list: list[str]) -> None:
+def format_copy_line(row: tuple) -> str:
+    # COPY text format : tab separated columns, and backslash escape of the special characters
+    fields = [str(value).replace('\\','\\\\').replace('\t','\\t').replace('\n','\\n').replace('\r','\\r') for value in row]
+    return '\t'.join(fields) + '\n'
+
+
+########################################################################################################################
+class CopyRowStream:
+    # file-like object used by cursor.copy_expert() : the COPY buffer is built on the fly, row by row
+
+    def __init__(self, rows: list[tuple]):
+        self.lines = (format_copy_line(row) for row in rows)
+        self.buffer = ''
+
+    def read(self, size: int = -1) -> str:
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.lines)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self.buffer)
+        chunk, self.buffer = self.buffer[:size], self.buffer[size:]
+        return chunk
+
+    def readline(self, size: int = -1) -> str:
+        return self.read(size)
+
+
+########################################################################################################################
+@logit("Stream scans to a staging table using COPY, then merge them in the table", level=logging.INFO)
+def copy_rows_to_database(cur: psycopg2.extensions.cursor, schema: str, table: str, insert_rows: list[tuple[str, str, str]]) -> int:
 
     log = niix2bids.utils.get_logger()
 
+    staging = f"{table}_staging"
+
+    cur.execute(f"CREATE TEMPORARY TABLE {staging} (dict jsonb, suid varchar(128), patient_id varchar(128)) ON COMMIT DROP;")
+    cur.copy_expert(f"COPY {staging} (dict, suid, patient_id) FROM STDIN;", CopyRowStream(insert_rows))
+    log.info(f"Copied {len(insert_rows):,} rows in {staging}")
+
+    columns = nifti2database.schema.get_existing_columns(cur, schema, table)
+    column_list, select_list = nifti2database.schema.get_insert_lists(columns)
+    cur.execute(f"INSERT INTO {schema}.{table} ({column_list}) "
+                f"SELECT {select_list} FROM {staging} "
+                f"ON CONFLICT (suid) DO NOTHING;")
+    log.info(f"Merged {cur.rowcount:,} rows from {staging} in {schema}.{table}")
+
+    return cur.rowcount
+
+
+########################################################################################################################
+def get_output_file(logfile: str, ext: str = None) -> str:
+
     # generate random id
     id = ''.join(random.choice(string.ascii_lowercase + string.ascii_uppercase + string.digits) for _ in range(8))
 
     # add id as suffix to logfile
-    name, ext = os.path.splitext(logfile)
-    insert_file = f"{name}_{id}{ext}"
-    insert_fullpath = os.path.join(os.path.dirname(logfile), insert_file)
+    name, logfile_ext = os.path.splitext(logfile)
+    output_file = f"{name}_{id}{ext if ext else logfile_ext}"
+    return os.path.join(os.path.dirname(logfile), output_file)
+
+
+########################################################################################################################
+@logit(f"Writing COPY file",level=logging.INFO)
+def write_copy_file(copy_fullpath: str, schema: str, table: str, insert_rows: list[tuple[str, str, str]]) -> None:
+
+    log = niix2bids.utils.get_logger()
+
+    log.info(f"writing COPY rows in : {copy_fullpath}")
+
+    # there is no now() in a file : the insertion time is the time of writing
+    insertion_time = datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+    with open(copy_fullpath, mode='at', encoding='utf-8') as fp:
+        for dict_str, suid, patient_id in insert_rows:
+            fp.write(format_copy_line((dict_str, suid, patient_id, insertion_time)))
+
+    log.info(f"load it with : psql -c \"\\copy {schema}.{table} (dict, suid, patient_id, insertion_time) FROM '{copy_fullpath}'\"")
+
+
+########################################################################################################################
+@logit(f"Writing INSERT lines to file",level=logging.INFO)
+def write_insert_list(insert_fullpath: str, insert_list: list[str]) -> None:
+
+    log = niix2bids.utils.get_logger()
 
     log.info(f"writing INSERT lines in : {insert_fullpath}")
 
-    # write
-    with open(insert_fullpath , mode='wt', encoding='utf-8' ) as fp:
-        fp.write('\n'.join(insert_list))
+    # write, in append mode since the workflow can write several chunks in the same file
+    with open(insert_fullpath , mode='at', encoding='utf-8' ) as fp:
+        for insert_line in insert_list:
+            fp.write(insert_line + '\n')
+
+
+########################################################################################################################
+class ThreadReportHandler(logging.Handler):
+    # 1 report per thread that started a capture : concurrent runs (API) do not mix their logs
+
+    def __init__(self):
+        super().__init__()
+        self.set_name('nifti2database_thread_report')
+        self.streams = {}  # thread ident -> StringIO
+
+    def emit(self, record: logging.LogRecord) -> None:
+        stream = self.streams.get(record.thread)
+        if stream is not None:
+            stream.write(self.format(record) + '\n')
+
+    @staticmethod
+    def drop(record: logging.LogRecord) -> bool:
+        # filter of the shared report : once the threads capture their own report, nothing reads the shared one,
+        # so the logs of the other threads (connection pool, /query...) would build up in it for the life of the process
+        return False
+
+
+report_lock = threading.Lock()
+
+
+########################################################################################################################
+def get_thread_report_handler() -> ThreadReportHandler:
+
+    root = logging.getLogger()
+
+    with report_lock:
+        for handler in root.handlers:
+            if handler.get_name() == 'nifti2database_thread_report':
+                return handler
+
+        thread_handler = ThreadReportHandler()
+        for handler in root.handlers:
+            if handler.get_name() == 'niix2bids_report':
+                thread_handler.setFormatter(handler.formatter)  # same report format
+                handler.addFilter(thread_handler.drop)
+                handler.stream.truncate(0)
+                handler.stream.seek(0)
+        root.addHandler(thread_handler)
+
+        return thread_handler
+
+
+########################################################################################################################
+def start_report_capture() -> None:
+    # from now, get_report() in this thread only returns the logs of this thread
+    get_thread_report_handler().streams[threading.get_ident()] = io.StringIO()
+
+
+########################################################################################################################
+def stop_report_capture() -> None:
+    get_thread_report_handler().streams.pop(threading.get_ident(), None)
 
 
 ########################################################################################################################
 def get_report() -> str:
+    for handler in logging.getLogger().handlers:
+        if handler.get_name() == 'nifti2database_thread_report' and threading.get_ident() in handler.streams:
+            stream = handler.streams[threading.get_ident()]
+            report = stream.getvalue()
+            stream.truncate(0)
+            stream.seek(0)
+            return report
     for handler in logging.getLogger().handlers:
         if handler.get_name() == 'niix2bids_report':
             report = handler.stream.getvalue()
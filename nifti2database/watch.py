@@ -0,0 +1,297 @@
+# standard modules
+import argparse  # parser of the watch mode
+import os        # for path management
+import signal    # stop the daemon cleanly
+import threading # the watchdog observer runs in its own thread
+import time      # debounce
+
+# dependency modules
+import niix2bids
+import psycopg2
+
+try:  # optional : inotify events, otherwise the archive is polled
+    import watchdog.events
+    import watchdog.observers
+except ImportError:
+    watchdog = None
+
+# local modules
+import nifti2database
+
+
+NIFTI_EXTENSIONS = ('.nii', '.nii.gz', '.json')
+
+# a session that fails on a database error (lost connection, timeout...) is processed again after a delay,
+# doubled at each attempt : after MAX_RETRIES attempts, it is dropped
+MAX_RETRIES     = 5
+RETRY_DELAY     = 10   # seconds
+MAX_RETRY_DELAY = 600  # seconds
+
+# errors of the chunks, see nifti2database.workflow.run_chunk() : 'stats['error']' starts with the exception name
+TRANSIENT_ERRORS = ('OperationalError', 'InterfaceError')
+
+
+########################################################################################################################
+def get_parser() -> argparse.ArgumentParser:
+
+    # same arguments as the CLI : '--in_dir' are the archive roots, each sub-directory being a session
+    parser = nifti2database.cli.get_parser()
+    parser.prog = 'nifti2database watch'
+    parser.description = """
+    Watch the archive roots, and run the pipeline on each session directory once its files stop changing.
+    '--in_dir' are the archive roots, such as /path/to/nii : each sub-directory is a session, such as /path/to/nii/2021_*
+    """
+
+    watch = parser.add_argument_group("Watch arguments")
+    watch.add_argument("--debounce",
+                       help="A session is processed when its .nii/.json files did not change for this time (default=30s)",
+                       metavar='SEC',
+                       type=float,
+                       default=30)
+    watch.add_argument("--poll_interval",
+                       help="Time between 2 scans of the archive roots, when inotify is not used (default=10s)",
+                       metavar='SEC',
+                       type=float,
+                       default=10)
+    watch.add_argument("--polling",
+                       help="Poll the archive roots instead of using inotify (watchdog package).\n"
+                            "Use it on network storage (NFS), where inotify does not see the changes made by other hosts",
+                       action='store_true')
+    watch.add_argument("--initial_scan",
+                       help="Process all existing sessions at startup, for the ones converted while the daemon was stopped",
+                       action='store_true')
+
+    return parser
+
+
+########################################################################################################################
+def get_session_dir(roots: list[str], path: str) -> str | None:
+    # the session is the first directory level under an archive root
+    for root in roots:
+        relative = os.path.relpath(path, root)
+        if relative != '.' and not relative.startswith(os.pardir):
+            return os.path.join(root, relative.split(os.sep)[0])
+    return None
+
+
+########################################################################################################################
+def get_session_state(session_dir: str) -> tuple:
+    # (path, size, mtime) of the .nii/.json files : the session is stable when it does not change anymore
+    state = []
+    for root, _, files in os.walk(session_dir):
+        for file in files:
+            if file.endswith(NIFTI_EXTENSIONS):
+                path = os.path.join(root, file)
+                try:
+                    file_stat = os.stat(path)
+                except FileNotFoundError:  # removed meanwhile
+                    continue
+                state.append((path, file_stat.st_size, file_stat.st_mtime_ns))
+    return tuple(sorted(state))
+
+
+########################################################################################################################
+def get_dir_state(roots: list[str]) -> dict[str, int]:
+    # mtime of the roots and of all sub-directories : a new file changes the mtime of its directory
+    # only directories are stat'ed, not the files, so polling a large archive stays cheap
+    dir_state = {}
+    for root in roots:
+        for dir_path, _, _ in os.walk(root):
+            try:
+                dir_state[dir_path] = os.stat(dir_path).st_mtime_ns
+            except FileNotFoundError:
+                continue
+    return dir_state
+
+
+########################################################################################################################
+class SessionQueue:
+    # sessions with recent changes, and the time of their last change
+
+    def __init__(self, roots: list[str], debounce: float):
+        self.roots    = roots
+        self.debounce = debounce
+        self.pending  = {}  # session_dir -> (time of last change, state at last check)
+        self.lock     = threading.Lock()
+
+    def mark(self, path: str) -> None:
+        session_dir = get_session_dir(self.roots, path)
+        if session_dir is None:
+            return
+        with self.lock:
+            _, state = self.pending.get(session_dir, (None, None))
+            self.pending[session_dir] = (time.monotonic(), state)
+
+    def retry(self, session_dir: str, delay: float) -> None:
+        # the last change is set in the future : the session is due after 'delay' + the debounce time
+        with self.lock:
+            self.pending[session_dir] = (time.monotonic() + delay, None)
+
+    def pop_stable(self) -> list[str]:
+        # sessions whose last change is older than the debounce time, and whose files did not change since last check
+        now = time.monotonic()
+        with self.lock:
+            due = [session_dir for session_dir, (last_change, _) in self.pending.items() if now - last_change >= self.debounce]
+
+        stable = []
+        for session_dir in due:
+            if not os.path.isdir(session_dir):  # removed since the event
+                with self.lock:
+                    self.pending.pop(session_dir, None)
+                continue
+            state = get_session_state(session_dir)  # outside the lock : it can be slow on NFS
+            newest = max([mtime for _, _, mtime in state], default=0) / 1e9
+            with self.lock:
+                last_change, previous_state = self.pending[session_dir]
+                if now - last_change < self.debounce:  # new event meanwhile
+                    continue
+                # first check : the mtime of the files tell if they are still being written
+                # next checks : the files must not have changed since the previous one
+                if (previous_state is None and time.time() - newest < self.debounce) or \
+                   (previous_state is not None and state != previous_state):
+                    self.pending[session_dir] = (now, state)  # check again later
+                    continue
+                del self.pending[session_dir]
+            stable.append(session_dir)
+
+        return stable
+
+
+########################################################################################################################
+def start_observer(roots: list[str], queue: SessionQueue):
+
+    class EventHandler(watchdog.events.FileSystemEventHandler):
+        def on_any_event(self, event):
+            queue.mark(event.src_path)
+            if hasattr(event, 'dest_path') and event.dest_path:  # moved
+                queue.mark(event.dest_path)
+
+    observer = watchdog.observers.Observer()
+    for root in roots:
+        observer.schedule(EventHandler(), root, recursive=True)
+    observer.start()
+    return observer
+
+
+########################################################################################################################
+def get_connection(args: argparse.Namespace,
+                   database: tuple[psycopg2.extensions.connection, str, str]) -> tuple[psycopg2.extensions.connection, str, str]:
+    # 1 connection for the whole life of the daemon, opened again if it was lost
+    if database is not None and not database[0].closed:
+        return database
+    return nifti2database.utils.connect_to_datase(args.connect_or_prepare, args.credentials)
+
+
+########################################################################################################################
+def run(args: argparse.Namespace) -> None:
+
+    log = niix2bids.utils.get_logger()
+
+    roots = args.in_dir
+    queue = SessionQueue(roots, args.debounce)
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+
+    if args.initial_scan:
+        for root in roots:
+            for entry in os.scandir(root):
+                if entry.is_dir():
+                    queue.mark(entry.path)
+
+    observer = None
+    dir_state = {}
+    if args.polling or watchdog is None:
+        if not args.polling:
+            log.warning("watchdog package not found : polling the archive roots")
+        dir_state = get_dir_state(roots)
+        log.info(f"Watching {roots} : polling every {args.poll_interval}s")
+    else:
+        observer = start_observer(roots, queue)
+        log.info(f"Watching {roots} : inotify")
+
+    database = None
+    if args.connect_or_prepare == "connect":
+        database = get_connection(args, None)
+
+    attempts = {}  # session_dir -> number of failed attempts on a database error
+
+    try:
+        while not stop.is_set():
+
+            if observer is None:
+                new_dir_state = get_dir_state(roots)
+                for dir_path, mtime in new_dir_state.items():
+                    if dir_state.get(dir_path) != mtime:
+                        queue.mark(dir_path)
+                dir_state = new_dir_state
+
+            for session_dir in queue.pop_stable():
+
+                log.info(f"Session is stable, processing : {session_dir}")
+                session_args = argparse.Namespace(**vars(args))
+                session_args.in_dir = [session_dir]
+                session_args.chunk_size = 1
+
+                # only the database errors are worth a retry : a malformed file fails the same way each time
+                transient = False
+                try:
+                    if args.connect_or_prepare == "connect":
+                        database = get_connection(args, database)
+                    results = []
+                    nifti2database.workflow.run(session_args, sysexit=False, database=database, results=results)
+                    for stats in results:  # the workflow catches the errors of each chunk
+                        if stats['error'] is not None:
+                            log.error(f"Error while processing {session_dir} : {stats['error']}")
+                            transient |= stats['error'].split(':')[0] in TRANSIENT_ERRORS
+                except (psycopg2.OperationalError, psycopg2.InterfaceError):  # InterfaceError : rollback on a lost connection
+                    log.exception(f"Database error while processing {session_dir}")
+                    transient = True
+                except Exception:
+                    log.exception(f"Error while processing {session_dir}")
+
+                if database is not None and not database[0].closed:
+                    try:
+                        database[0].rollback()
+                    except psycopg2.Error:
+                        database[0].close()
+                # a lost connection is opened again by get_connection() for the next session
+                transient |= database is not None and database[0].closed > 0
+
+                if not transient:
+                    attempts.pop(session_dir, None)
+                    continue
+                attempts[session_dir] = attempts.get(session_dir, 0) + 1
+                if attempts[session_dir] > MAX_RETRIES:
+                    log.error(f"{session_dir} failed {MAX_RETRIES + 1} times : dropped, until its next change")
+                    del attempts[session_dir]
+                    continue
+                delay = min(RETRY_DELAY * 2 ** (attempts[session_dir] - 1), MAX_RETRY_DELAY)
+                log.warning(f"{session_dir} will be processed again in {delay:.0f}s (retry {attempts[session_dir]}/{MAX_RETRIES})")
+                queue.retry(session_dir, delay)
+
+            stop.wait(min(args.poll_interval, args.debounce) if observer is None else min(1.0, args.debounce))
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        if observer is not None:
+            observer.stop()
+            observer.join()
+        if database is not None and not database[0].closed:
+            database[0].close()
+        log.info("Watch stopped")
+
+
+########################################################################################################################
+def main(argv: list[str] = None) -> None:
+
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    args = nifti2database.cli.format_args(args)
+
+    # initialize logger (console & file)
+    niix2bids.utils.init_logger(args.out_dir is not None, args.out_dir)
+
+    run(args)
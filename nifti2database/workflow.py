@@ -1,24 +1,44 @@
 # standard modules
-import argparse  # just for function signature
-import os        # for path management
-import sys       # to stop script execution on case of error
-import time      # to time execution of code
-import logging   # to access the log report
+import argparse              # just for function signature
+import os                    # for path management
+import sys                   # to stop script execution on case of error
+import time                  # to time execution of code
+import logging               # to access the log report
+import logging.handlers      # to capture the logs of the workers
+import sqlite3               # just for function signature
+import concurrent.futures    # pool of workers
+import multiprocessing       # start method of the workers
+import multiprocessing.util  # to close connections when a worker exits
+import threading             # the worker logs are replayed in the calling thread
+import typing                # just for function signature
 
 # dependency modules
 import niix2bids.utils
+import psycopg2              # just for function signature
 
 # local modules
 import nifti2database
+import nifti2database.metrics    # Metrics is used in function signatures
+import nifti2database.profiling  # Profiler is used in function signatures
 
 
 ########################################################################################################################
-def run(args: argparse.Namespace, sysexit: bool = True) -> str:
-
-    # ------------------------------------------------------------------------------------------------------------------
-    # from here, this a basically a copy-paste of niix2bids.workflow.run()
+def run(args: argparse.Namespace, sysexit: bool = True,
+        database: tuple[psycopg2.extensions.connection, str, str] = None,
+        progress: typing.Callable[[int, int], None] = None, results: list[dict] = None,
+        metrics: dict = None, profile: dict = None) -> str:
+    # database : (con, schema, table) borrowed from the caller, such as the connection pool of the API
+    # it is not closed at the end of the run
+    # progress : called with (nChunkDone, nChunk) after each chunk
+    # results  : if a list is given, it receives the statistics of each chunk (see new_chunk_stats),
+    #            and an error in a chunk is stored there instead of stopping the run
+    # metrics  : if a dict is given, it receives the metrics of the run (see nifti2database.metrics.Metrics.to_dict)
+    # profile  : if a dict is given and '--profile' is used, it receives the text report of the profiler in 'report'
 
     star_time = time.time()
+    run_metrics = nifti2database.metrics.Metrics()
+    profiler = nifti2database.profiling.Profiler(args.profile)
+    run_metrics.hooks.append(profiler.stage_end)
 
     # create output dir id needed
     if args.out_dir and not os.path.exists(args.out_dir):
@@ -30,10 +50,17 @@ def run(args: argparse.Namespace, sysexit: bool = True) -> str:
     # logs
     log.info(f"in_dir  : {args.in_dir}")
     log.info(f"out_dir : {args.out_dir}")
+    log_prefix = None  # the metrics and the profile are written next to the log file
     if args.out_dir:
         logfile = log.__class__.root.handlers[1].baseFilename
         log.info(f"logfile : {logfile}")
+        log_prefix = os.path.splitext(logfile)[0]
     log.info(f"connect_or_prepare : {args.connect_or_prepare}")
+    log.info(f"copy : {args.copy}")
+    log.info(f"cache : {args.cache}")
+    log.info(f"chunk_size : {args.chunk_size}")
+    log.info(f"workers : {args.workers}")
+    log.info(f"profile : {args.profile}")
 
     if args.connect_or_prepare == 'prepare' and args.out_dir is None:
         log.error(f"if '--prepare' is used , '--out_dir' has to be defined too")
@@ -42,6 +69,13 @@ def run(args: argparse.Namespace, sysexit: bool = True) -> str:
         else:
             return nifti2database.utils.get_report()
 
+    if args.cache and args.out_dir is None:
+        log.error(f"if '--cache' is used , '--out_dir' has to be defined too")
+        if sysexit:
+            sys.exit(1)
+        else:
+            return nifti2database.utils.get_report()
+
     # check for credentials file
     if args.connect_or_prepare == "connect":
         if not os.path.exists(args.credentials):
@@ -54,63 +88,390 @@ def run(args: argparse.Namespace, sysexit: bool = True) -> str:
             log.info(f"credentials : {args.credentials}")
 
     # check if input dir exists
-    for one_dir in args.in_dir:
+    # with per-directory results (batch), each chunk checks its own directories : the others are still processed
+    if results is None:
+        for one_dir in args.in_dir:
+            if not os.path.exists(one_dir):
+                log.error(f"in_dir does not exist : {one_dir}")
+                if sysexit:
+                    sys.exit(1)
+                else:
+                    return nifti2database.utils.get_report()
+
+    # load config file, or reuse it if it did not change since the previous run of this process
+    with run_metrics.stage('load_config_file'):
+        config = nifti2database.config.load_config_file(args.config_file)
+
+    # output file for '--prepare', all chunks are appended in it
+    prepare_file = None
+    if args.connect_or_prepare == "prepare":
+        prepare_file = nifti2database.utils.get_output_file(logfile, '.copy' if args.copy else None)
+
+    # the directories are processed chunk by chunk : peak memory is bounded by the chunk size, not the archive size
+    # with several workers, use 1 directory per chunk by default, so the load is balanced between the workers
+    if args.chunk_size > 0:
+        chunk_size = args.chunk_size
+    elif args.workers > 1:
+        chunk_size = 1
+    else:
+        chunk_size = len(args.in_dir)
+    chunk_list = nifti2database.utils.split_in_batch(args.in_dir, chunk_size)
+
+    if args.workers > 1:
+        run_parallel(args, chunk_list, config, prepare_file, progress, results, run_metrics, profiler)
+        return end_of_run(star_time, sysexit, run_metrics, profiler, log_prefix, metrics, profile)
+
+    # open the file state cache
+    cache = None
+    if args.cache:
+        cache = nifti2database.cache.open_file_cache(args.out_dir)
+
+    # connect to database
+    if database is not None and args.connect_or_prepare == "connect":
+        con, schema, table = database
+        log.info("Using a connection from the pool")
+    else:
+        with run_metrics.stage('connect_to_datase'):
+            con, schema, table = nifti2database.utils.connect_to_datase(args.connect_or_prepare, args.credentials)
+
+    for idx, chunk_dir in enumerate(chunk_list):
+        if len(chunk_list) > 1:
+            log.info(f"chunk {idx+1}/{len(chunk_list)} : {chunk_dir}")
+        stats = new_chunk_stats(chunk_dir)
+        try:
+            with profiler.chunk(str(chunk_dir), idx):
+                insert_rows = run_chunk(args, chunk_dir, config, con, schema, table, cache, stats, run_metrics)
+        except Exception as exc:
+            if results is None:
+                raise
+            log.exception(f"Error while processing chunk : {chunk_dir}")
+            stats['error'] = f"{type(exc).__name__}: {exc}"
+            insert_rows = []
+            if con is not None:
+                con.rollback()  # only this chunk : the previous ones are already committed by insert_scan_to_database
+        run_metrics.add_chunk(stats)
+        if results is not None:
+            results.append(stats)
+        if prepare_file is not None:
+            with run_metrics.stage('write_prepare_file'):
+                write_prepare_file(args, prepare_file, schema, table, insert_rows)
+        if progress is not None:
+            progress(idx+1, len(chunk_list))
+
+    if con is not None and database is None:
+        con.close()
+        log.info("Connection to database closed")
+
+    if cache is not None:
+        cache.close()
+
+    return end_of_run(star_time, sysexit, run_metrics, profiler, log_prefix, metrics, profile)
+
+
+########################################################################################################################
+def run_parallel(args: argparse.Namespace, chunk_list: list[list[str]], config: list, prepare_file: str,
+                 progress: typing.Callable[[int, int], None] = None, results: list[dict] = None,
+                 run_metrics: nifti2database.metrics.Metrics = None,
+                 profiler: nifti2database.profiling.Profiler = None) -> None:
+    # run_metrics, profiler : receive the stages measured and the chunks profiled in the workers
+
+    log = niix2bids.utils.get_logger()
+
+    if run_metrics is None:
+        run_metrics = nifti2database.metrics.Metrics()
+    if profiler is None:
+        profiler = nifti2database.profiling.Profiler(args.profile)
+
+    log.info(f"Dispatching {len(chunk_list):,} chunks to {args.workers} workers")
+
+    # 'spawn' : fork() in a multithreaded process (API, watch with inotify) can copy a lock held by another thread,
+    # and the worker hangs on it. A spawned worker starts from scratch : init_worker() sets all its state
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers,
+                                                mp_context=multiprocessing.get_context('spawn'),
+                                                initializer=init_worker,
+                                                initargs=(args, config, logging.getLogger().level)) as executor:
+
+        futures = [executor.submit(run_worker, chunk_dir, idx) for idx, chunk_dir in enumerate(chunk_list)]
+
+        # results are collected in submission order, so the log file reads like the serial one, chunk after chunk
+        for idx, (chunk_dir, future) in enumerate(zip(chunk_list, futures)):
+            log.info(f"chunk {idx+1}/{len(chunk_list)} : {chunk_dir}")
+            records, insert_rows, success, stats, chunk_metrics, chunk_profile = future.result()
+
+            # send the worker logs to the handlers of this process (console, file, report)
+            # as if they were emitted by this thread, so they go in the report of this run
+            for record in records:
+                record.thread, record.threadName = threading.get_ident(), threading.current_thread().name
+                logging.getLogger(record.name).handle(record)
+
+            run_metrics.merge(chunk_metrics)
+            profiler.merge(chunk_profile)
+            run_metrics.add_chunk(stats)
+
+            # the hooks of this process did not see the rows committed by the worker
+            if args.connect_or_prepare == "connect" and stats['scans_inserted'] > 0:
+                nifti2database.utils.run_commit_hooks(None, None, stats['scans_inserted'])
+
+            if results is not None:
+                results.append(stats)
+            elif not success:
+                executor.shutdown(wait=True, cancel_futures=True)
+                raise RuntimeError(f"worker failed on chunk : {chunk_dir}")
+
+            if prepare_file is not None:
+                with run_metrics.stage('write_prepare_file'):
+                    write_prepare_file(args, prepare_file, None, None, insert_rows)
+            if progress is not None:
+                progress(idx+1, len(chunk_list))
+
+
+########################################################################################################################
+class RecordListHandler(logging.handlers.QueueHandler):
+    # store the log records of a worker, so they can be sent back to the main process
+
+    def __init__(self):
+        super().__init__(None)
+        self.records = []
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        self.records.append(record)
+
+
+# state of a worker process, set once by init_worker() and used by each run_worker() call
+worker_state = {}
+
+
+########################################################################################################################
+def init_worker(args: argparse.Namespace, config: list, level: int) -> None:
+
+    # capture the records instead of writing them : they are replayed by the main process, in its handlers
+    handler = RecordListHandler()
+    root = logging.getLogger()
+    for inherited_handler in list(root.handlers):
+        root.removeHandler(inherited_handler)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    # each worker has its own cache and database connection
+    # an exception here would break the whole pool without any log, so keep it for the first run_worker() call
+    try:
+        cache = None
+        if args.cache:
+            cache = nifti2database.cache.open_file_cache(args.out_dir)
+            multiprocessing.util.Finalize(None, cache.close, exitpriority=10)
+
+        con, schema, table = nifti2database.utils.connect_to_datase(args.connect_or_prepare, args.credentials)
+
+        if con is not None:
+            multiprocessing.util.Finalize(None, con.close, exitpriority=10)
+
+        worker_state.update(args=args, config=config, handler=handler,
+                            cache=cache, con=con, schema=schema, table=table, init_success=True)
+
+    except Exception:
+        niix2bids.utils.get_logger().exception("Error during the initialization of the worker")
+        worker_state.update(handler=handler, init_success=False)
+
+
+########################################################################################################################
+def run_worker(chunk_dir: list[str], chunk_idx: int) -> tuple[list[logging.LogRecord], list[tuple[str, str, str]],
+                                                              bool, dict, dict, dict]:
+
+    log = niix2bids.utils.get_logger()
+    state = worker_state
+
+    insert_rows = []
+    stats = new_chunk_stats(chunk_dir)
+    chunk_metrics = nifti2database.metrics.Metrics()
+    success = state['init_success']
+    chunk_profiler = nifti2database.profiling.Profiler(state['args'].profile if success else 0)
+    chunk_metrics.hooks.append(chunk_profiler.stage_end)
+    if not success:
+        stats['error'] = "worker initialization failed"
+    try:
+        if success:
+            with chunk_profiler.chunk(str(chunk_dir), chunk_idx):
+                insert_rows = run_chunk(state['args'], chunk_dir, state['config'],
+                                        state['con'], state['schema'], state['table'], state['cache'], stats, chunk_metrics)
+    except Exception as exc:
+        log.exception(f"Error while processing chunk : {chunk_dir}")
+        stats['error'] = f"{type(exc).__name__}: {exc}"
+        success = False
+        if state['con'] is not None:
+            state['con'].rollback()
+
+    records, state['handler'].records = state['handler'].records, []
+
+    return records, insert_rows, success, stats, chunk_metrics.to_dict(), chunk_profiler.to_dict()
+
+
+########################################################################################################################
+def write_prepare_file(args: argparse.Namespace, prepare_file: str, schema: str, table: str,
+                       insert_rows: list[tuple[str, str, str]]) -> None:
+
+    if args.connect_or_prepare != "prepare":
+        return
+
+    if args.copy:
+        nifti2database.utils.write_copy_file(prepare_file, schema, table, insert_rows)
+    else:
+        insert_list = nifti2database.utils.render_insert_list(schema, table, insert_rows, args.batch_size)
+        nifti2database.utils.write_insert_list(prepare_file, insert_list)
+
+
+########################################################################################################################
+def new_chunk_stats(in_dir: list[str]) -> dict:
+    return {
+        'in_dir'             : in_dir,
+        'files'              : 0,     # .nii files with their .json found in the directories
+        'volumes'            : 0,     # new or modified volumes found in the directories
+        'volumes_unchanged'  : 0,     # skipped by the file state cache
+        'volumes_in_database': 0,     # skipped because their series is already in database
+        'scans'              : 0,     # scans built from the remaining volumes
+        'scans_inserted'     : 0,     # scans inserted in the database (or written in the '--prepare' file)
+        'scans_skipped'      : 0,     # scans already in database
+        'bytes_sent'         : 0,     # size of the JSON of the scans sent to the database (or written in the file)
+        'error'              : None,
+    }
+
+
+########################################################################################################################
+def run_chunk(args: argparse.Namespace, in_dir: list[str], config: list,
+              con: psycopg2.extensions.connection, schema: str, table: str,
+              cache: sqlite3.Connection, stats: dict = None,
+              metrics: nifti2database.metrics.Metrics = None) -> list[tuple[str, str, str]]:
+
+    log = niix2bids.utils.get_logger()
+
+    if stats is None:
+        stats = new_chunk_stats(in_dir)
+    if metrics is None:
+        metrics = nifti2database.metrics.Metrics()
+
+    for one_dir in in_dir:
         if not os.path.exists(one_dir):
-            log.error(f"in_dir does not exist : {one_dir}")
-            if sysexit:
-                sys.exit(1)
-            else:
-                return nifti2database.utils.get_report()
+            raise FileNotFoundError(f"in_dir does not exist : {one_dir}")
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # from here, this a basically a copy-paste of niix2bids.workflow.run()
+
+    with metrics.stage('fetch_all_files'):
+
+        # read all dirs and establish file list
+        file_list = niix2bids.utils.fetch_all_files(in_dir)
+
+        # isolate .nii files
+        file_list_nii = niix2bids.utils.isolate_nii_files(file_list)
+
+        # check if all .nii files have their own .json
+        file_list_nii, file_list_json = niix2bids.utils.check_if_json_exists(file_list_nii)
+
+    stats['files'] = len(file_list_nii)
 
-    # load config file
-    config = niix2bids.utils.load_config_file(args.config_file)
+    # skip files already processed by a previous run, before any parsing
+    # with '--prepare', nothing is in the database yet : the cache is read, but not updated
+    file_state = None
+    update_cache = cache is not None and args.connect_or_prepare == "connect"
+    if cache is not None:
+        nFile = len(file_list_nii)
+        with metrics.stage('filter_unchanged_files'):
+            file_list_nii, file_list_json, file_state = nifti2database.cache.filter_unchanged_files(cache, file_list_nii, file_list_json)
+        stats['volumes_unchanged'] = nFile - len(file_list_nii)
+        if len(file_list_nii) == 0:
+            log.info("No new or modified file since the last run")
+            return []
 
-    # read all dirs and establish file list
-    file_list = niix2bids.utils.fetch_all_files(args.in_dir)
+    if len(file_list_nii) == 0:
+        log.warning(f"No nifti file found in : {in_dir}")
+        return []
+    stats['volumes'] = len(file_list_nii)
 
-    # isolate .nii files
-    file_list_nii = niix2bids.utils.isolate_nii_files(file_list)
+    with metrics.stage('read_all_json'):
 
-    # check if all .nii files have their own .json
-    file_list_nii, file_list_json = niix2bids.utils.check_if_json_exists(file_list_nii)
+        # create Volume objects, in a list that belongs to this run only
+        volume_list = nifti2database.utils.create_volume_list(file_list_nii)
 
-    # create Volume objects
-    volume_list = niix2bids.utils.create_volume_list(file_list_nii)
+        # read all json files
+        niix2bids.utils.read_all_json(volume_list)
 
-    # read all json files
-    niix2bids.utils.read_all_json(volume_list)
+    # prune the volumes already in database, before the expensive steps
+    db_id = None
+    if con is not None:
+        with metrics.stage('fetch_existing_series'):
+            suid_list = [vol.seqparam['SeriesInstanceUID'] for vol in volume_list if 'SeriesInstanceUID' in vol.seqparam]
+            db_id = nifti2database.utils.fetch_existing_series(con, schema, table, suid_list, args.batch_size)
+            nVolume = len(volume_list)
+            volume_list = nifti2database.utils.remove_existing_volumes(volume_list, db_id)
+        stats['volumes_in_database'] = nVolume - len(volume_list)
+        if len(volume_list) == 0:
+            log.info("No new volume : all series are already in database")
+            if update_cache:
+                nifti2database.cache.update_file_cache(cache, file_state)
+            return []
 
     # apply decision tree
     # !! here, only Siemens is implemented !!
-    df = niix2bids.decision_tree.siemens.run(volume_list, config)
+    with metrics.stage('decision_tree'):
+        df = niix2bids.decision_tree.siemens.run(volume_list, config)
 
     # to here
     # ------------------------------------------------------------------------------------------------------------------
 
     # logs from niix2bids.utils.apply_bids_architecture
     nifti2database.utils.display_logs_from_decision_tree(volume_list)
-    
+
     # read all nifti headers
-    df = nifti2database.utils.read_all_nifti_header(df)
+    with metrics.stage('read_all_nifti_header'):
+        df = nifti2database.utils.read_all_nifti_header(df, args.jobs)
 
     # concatenate the bidsfields with the jsondict (seqparam)
-    df = nifti2database.utils.concat_bidsfields_to_seqparam(df)
+    with metrics.stage('concat_bidsfields_to_seqparam'):
+        df = nifti2database.utils.concat_bidsfields_to_seqparam(df)
 
     # ok here is the most important part : regroup volumes by scan
-    scans = nifti2database.utils.build_scan_from_series(df, config)
-
-    # duplicate happen during dev, but should not happen for production
-    # anyway, check it and log it
-    scans = nifti2database.utils.remove_duplicate(scans)
+    with metrics.stage('build_scan_from_series'):
+        scans = nifti2database.utils.build_scan_from_series(df, config)
 
-    # connect to database
-    con, schema, table = nifti2database.utils.connect_to_datase(args.connect_or_prepare, args.credentials)
+        # duplicate happen during dev, but should not happen for production
+        # anyway, check it and log it
+        scans = nifti2database.utils.remove_duplicate(scans)
+    stats['scans'] = len(scans)
 
     # insert scans to database
-    insert_list = nifti2database.utils.insert_scan_to_database(con, schema, table, scans)
+    with metrics.stage('insert_scan_to_database'):
+        insert_rows = nifti2database.utils.insert_scan_to_database(con, schema, table, scans,
+                                                                   args.batch_size, args.commit_mode, args.copy, db_id, stats)
 
-    if args.connect_or_prepare == "prepare":
-        nifti2database.utils.write_insert_list(logfile, insert_list)
+    # the chunk is complete : next run can skip these files
+    if update_cache:
+        nifti2database.cache.update_file_cache(cache, file_state)
+
+    return insert_rows
+
+
+########################################################################################################################
+def end_of_run(star_time: float, sysexit: bool, run_metrics: nifti2database.metrics.Metrics = None,
+               profiler: nifti2database.profiling.Profiler = None, log_prefix: str = None,
+               metrics: dict = None, profile: dict = None) -> str:
+
+    log = niix2bids.utils.get_logger()
+
+    if run_metrics is not None:
+        metrics_dict = run_metrics.to_dict()
+        nifti2database.metrics.log_metrics(metrics_dict)
+        nifti2database.metrics.add_to_totals(metrics_dict)
+        if log_prefix is not None:
+            nifti2database.metrics.write_metrics_file(log_prefix + '_metrics.json', metrics_dict)
+        if metrics is not None:
+            metrics.update(metrics_dict)
+
+    if profiler is not None and profiler.sample > 0:
+        if log_prefix is not None:
+            profiler.write(log_prefix + '_profile')
+        else:  # no file : the report goes to the log
+            log.info(f"profile report :\n{profiler.format_report()}")
+        if profile is not None:
+            profile['report'] = profiler.format_report()
 
     stop_time = time.time()
 
@@ -26,6 +26,9 @@ setuptools.setup(
         "psycopg2-binary",  # PostgreSQL + binary files instead of system lib
         "Flask"             # for API using HTTP
     ],
+    extras_require={
+        "watch": ["watchdog"],  # inotify events for 'nifti2database watch', otherwise the archive is polled
+    },
     entry_points={
         'console_scripts': [
             'nifti2database = nifti2database.cli:main'